@@ -0,0 +1,264 @@
+#!/usr/bin/python3
+# -*- Coding: utf-8 -*-
+
+"""
+busdaemon.py: A daemon sharing 1-wire buses between processes.
+Copyright (C) 2013 Anders Englund
+
+This file is part of RPi_UART_1-wire.
+
+RPi_UART_1-wire is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+RPi_UART_1-wire is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RPi_UART_1-wire.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Only one process can own a UART. This daemon owns one OneWire per UART and
+lets other processes read and search the buses over a Unix domain socket.
+
+Requests and responses are JSON objects, one per line:
+`
+{"op": "search", "bus": "ttyAMA0"}
+{"ok": true, "devices": ["2b0000047ff88528", ...], "time": ..., "cached": false}
+
+{"op": "read", "bus": "ttyAMA0", "id": "2b0000047ff88528", "maxAge": 5}
+{"ok": true, "value": 21.5, "time": ..., "cached": true}
+`
+"bus" may be left out when the daemon only owns one bus, and "maxAge"
+defaults to the TTL of the daemon.
+
+Concurrent requests for the same device are coalesced into one bus
+transaction, and a request is answered from the cache if a reading that is
+fresh enough exists.
+"""
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+
+import onewire
+
+# Define the default socket below
+defaultSocket = '/tmp/onewire.sock'
+
+class AlreadyRunning(Exception): pass
+
+
+class Pending:
+    """
+    A bus transaction in progress that other requests can wait for.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BusService:
+    """
+    Serializes all traffic on one OneWire and coalesces equal requests.
+    """
+    def __init__(self, ow, ttl = 1.0):
+        self.ow = ow
+        self.ttl = ttl
+
+        # Held while talking on the bus
+        self.busLock = threading.Lock()
+
+        # Protects pending and cache
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.cache = {}
+
+        self.transactions = 0
+
+        # Driver objects of the devices that have been read
+        self.registry = onewire.DeviceRegistry(ow, [])
+
+    def request(self, key, function, maxAge = None):
+        """
+        Return (timestamp, value, cached) for the request identified by key.
+
+        function is called to perform the bus transaction unless a fresh
+        enough result is cached, or the same request is already running.
+        """
+        if maxAge is None:
+            maxAge = self.ttl
+
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached and time.time() - cached[0] <= maxAge:
+                return cached[0], cached[1], True
+
+            pending = self.pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = Pending()
+                self.pending[key] = pending
+
+        if not owner:
+            # Someone else is already asking the bus the same thing
+            pending.event.wait()
+            if pending.error:
+                raise pending.error
+            return pending.result[0], pending.result[1], True
+
+        try:
+            with self.busLock:
+                self.transactions += 1
+                value = function()
+            pending.result = (time.time(), value)
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.pending[key]
+                if pending.error is None:
+                    self.cache[key] = pending.result
+            pending.event.set()
+
+        return pending.result[0], pending.result[1], False
+
+    def search(self, maxAge = None):
+        return self.request(('search',), self.ow.search, maxAge)
+
+    def read(self, deviceID, maxAge = None):
+        if (deviceID & 0xFF) != 0x28:
+            raise ValueError('Device %016x is not a DS18B20' % deviceID)
+
+        with self.lock:
+            sensor = self.registry.add(deviceID)
+        return self.request(('read', deviceID),
+                            lambda: sensor.readTemp(checkCRC = True), maxAge)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.dispatch(json.loads(line.decode()))
+                response['ok'] = True
+            except Exception as e:
+                logging.warning('Request %r failed: %s', line, e)
+                response = {'ok': False, 'error': str(e)}
+
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+class BusDaemon(socketserver.ThreadingUnixStreamServer):
+    """
+    Serve requests for a number of buses on a Unix domain socket.
+
+    buses is a dict with bus name: BusService
+    """
+    daemon_threads = True
+
+    def __init__(self, buses, path = defaultSocket):
+        self.buses = buses
+
+        # Remove a socket left behind by a previous daemon, but not one
+        # that a running daemon still listens on. Two daemons would open the
+        # same UART.
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:
+                os.remove(path)
+            else:
+                raise AlreadyRunning('A daemon is already listening on %s'
+                                     % path)
+            finally:
+                probe.close()
+
+        socketserver.ThreadingUnixStreamServer.__init__(self, path,
+                                                        RequestHandler)
+
+    def getBus(self, name):
+        if name is None:
+            if len(self.buses) != 1:
+                raise ValueError('No bus given, and there are %d buses' %
+                                 len(self.buses))
+            return next(iter(self.buses.values()))
+
+        if name not in self.buses:
+            raise ValueError('Unknown bus %s' % name)
+        return self.buses[name]
+
+    def dispatch(self, request):
+        bus = self.getBus(request.get('bus'))
+        maxAge = request.get('maxAge')
+
+        if request['op'] == 'search':
+            timestamp, devices, cached = bus.search(maxAge)
+            return {'devices': ['%016x' % d for d in devices],
+                    'time': timestamp,
+                    'cached': cached}
+        elif request['op'] == 'read':
+            timestamp, value, cached = bus.read(int(request['id'], 16),
+                                                maxAge)
+            return {'value': value,
+                    'time': timestamp,
+                    'cached': cached}
+        else:
+            raise ValueError('Unknown op %s' % request['op'])
+
+
+def query(request, path = defaultSocket):
+    """
+    Send one request to the daemon and return the response as a dict.
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        f = s.makefile('rwb')
+        f.write(json.dumps(request).encode() + b'\n')
+        f.flush()
+        response = json.loads(f.readline().decode())
+    finally:
+        s.close()
+
+    if not response['ok']:
+        raise onewire.CommError(response['error'])
+    return response
+
+def readTemp(deviceID, bus = None, maxAge = None, path = defaultSocket):
+    """
+    Read the temperature of a DS18B20 through the daemon.
+    """
+    request = {'op': 'read', 'id': '%016x' % deviceID}
+    if bus is not None:
+        request['bus'] = bus
+    if maxAge is not None:
+        request['maxAge'] = maxAge
+    return query(request, path)['value']
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(format='%(asctime)s %(message)s',
+                        level=logging.WARNING)
+    ports = sys.argv[1:] or [onewire.usedSerialPort]
+
+    buses = {}
+    for port in ports:
+        buses[os.path.basename(port)] = BusService(onewire.OneWire(port = port))
+
+    server = BusDaemon(buses)
+    print('Serving %s on %s' % (', '.join(buses), defaultSocket))
+    server.serve_forever()
@@ -0,0 +1,130 @@
+"""
+deadband.py: Only pass on readings that have changed.
+Copyright (C) 2013 Anders Englund
+
+This file is part of RPi_UART_1-wire.
+
+RPi_UART_1-wire is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+RPi_UART_1-wire is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RPi_UART_1-wire.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Most sensors are stable for hours. This module implements a filter that sits
+between the reading of the sensors and the outputs, and only lets a reading
+through when:
+
+* it is the first reading of the sensor, or
+* it differs from the last emitted reading by more than the deadband, which
+  is the largest of an absolute value and a fraction of the last emitted
+  reading, or
+* it has not emitted anything for maxInterval seconds (heartbeat).
+
+A reading is never emitted sooner than minInterval seconds after the last
+one. A failed reading (NaN) is emitted when the sensor goes from working to
+failing and back.
+
+The state of each sensor is kept in arrays, with one row per ROM ID.
+"""
+
+import math
+import time
+from array import array
+
+
+class DeadbandFilter:
+    def __init__(self, absolute = 0.0625, relative = 0.0, minInterval = 0.0,
+                 maxInterval = None):
+        """
+        The arguments are the defaults for all sensors. Use configure() to
+        change them for a single sensor. maxInterval = None means no
+        heartbeat.
+        """
+        if maxInterval is None:
+            maxInterval = math.inf
+        self.defaults = (absolute, relative, minInterval, maxInterval)
+
+        # deviceID: row in the arrays below
+        self.index = {}
+
+        # Settings
+        self.absolute = array('d')
+        self.relative = array('d')
+        self.minInterval = array('d')
+        self.maxInterval = array('d')
+
+        # Last emitted reading
+        self.lastValue = array('d')
+        self.lastTime = array('d')
+
+    def row(self, deviceID):
+        """
+        Return the row of a sensor, adding it with the default settings if
+        it is new.
+        """
+        row = self.index.get(deviceID)
+        if row is None:
+            row = len(self.index)
+            self.index[deviceID] = row
+
+            absolute, relative, minInterval, maxInterval = self.defaults
+            self.absolute.append(absolute)
+            self.relative.append(relative)
+            self.minInterval.append(minInterval)
+            self.maxInterval.append(maxInterval)
+            self.lastValue.append(math.nan)
+            self.lastTime.append(-math.inf)
+        return row
+
+    def configure(self, deviceID, absolute = None, relative = None,
+                  minInterval = None, maxInterval = None):
+        """
+        Change the settings of one sensor. Settings given as None are kept.
+        """
+        row = self.row(deviceID)
+        if absolute is not None:
+            self.absolute[row] = absolute
+        if relative is not None:
+            self.relative[row] = relative
+        if minInterval is not None:
+            self.minInterval[row] = minInterval
+        if maxInterval is not None:
+            self.maxInterval[row] = maxInterval
+
+    def accept(self, deviceID, value, timestamp = None):
+        """
+        Return True if the reading should be passed on to the outputs. The
+        reading is then remembered as the last emitted one.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        row = self.row(deviceID)
+        elapsed = timestamp - self.lastTime[row]
+        if elapsed < self.minInterval[row]:
+            return False
+
+        last = self.lastValue[row]
+        if math.isnan(value) or math.isnan(last):
+            # First reading, or a reading failing or recovering
+            emit = math.isnan(value) != math.isnan(last) or \
+                   elapsed >= self.maxInterval[row]
+        else:
+            deadband = max(self.absolute[row],
+                           self.relative[row] * abs(last))
+            emit = abs(value - last) > deadband or \
+                   elapsed >= self.maxInterval[row]
+
+        if emit:
+            self.lastValue[row] = value
+            self.lastTime[row] = timestamp
+        return emit
@@ -0,0 +1,221 @@
+"""
+health.py: Monitor the health of a 1-wire bus and pick a speed to match.
+Copyright (C) 2013 Anders Englund
+
+This file is part of RPi_UART_1-wire.
+
+RPi_UART_1-wire is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+RPi_UART_1-wire is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RPi_UART_1-wire.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+A degrading bus shows up as a change in the shape of the presence pulse,
+slots where the read byte could not have been caused by what was written
+(echo errors), and finally as reads with bad CRC.
+
+BusHealth records these for each sweep of a bus and picks one of the speed
+profiles below. The profiles differ in how many slots are written to the
+UART in one go. Slots in the same batch follow each other with only the stop
+bit (8.7 us) in between, which is within the specification but leaves
+little time for a long bus to recover. Single slots have the whole round
+trip through the UART driver in between.
+
+The monitor starts with the fastest profile. When the error rate of a sweep
+rises above the limits, it falls back to the next slower profile. After
+probeAfter sweeps without errors it probes the next faster profile again.
+The probe succeeds once probeAfter more sweeps have been clean on the faster
+profile. Any error during the probe falls back again, and doubles the number
+of clean sweeps needed before the next probe, up to maxBackoff times
+probeAfter.
+
+A device that keeps failing at every profile, a detached or dead sensor for
+instance, is a fault of the device and not of the bus. Its errors do not
+count against the bus until it has been read correctly again.
+"""
+
+import collections
+import logging
+import time
+
+import onewire
+
+# Name and batch size, fastest first
+profiles = (('fast', 64),
+            ('normal', 8),
+            ('safe', 1))
+
+
+class BusHealth:
+    def __init__(self, ow, window = 100, maxEchoRate = 0.001,
+                 maxCRCRate = 0.01, probeAfter = 10, maxBackoff = 16):
+        self.ow = ow
+        self.maxEchoRate = maxEchoRate
+        self.maxCRCRate = maxCRCRate
+        self.probeAfter = probeAfter
+        self.maxBackoff = maxBackoff
+
+        # One entry per sweep:
+        # (time, profile, presence counts, slots, echo errors, reads,
+        #  CRC errors, missing devices)
+        self.history = collections.deque(maxlen = window)
+
+        self.cleanSweeps = 0
+        self.backoff = 1
+        self.probing = False
+        self.setProfile(0)
+
+        # Profiles at which each device has failed since it was last read
+        # correctly, and the devices that have failed at all profiles
+        self.failedAt = {}
+        self.faults = set()
+
+    def setProfile(self, index):
+        self.profile = index
+        self.ow.batchSize = profiles[index][1]
+
+    def sweep(self, registry):
+        """
+        Sweep all readable devices of a registry, like registry.sweep(),
+        and record the health of the bus during the sweep.
+        """
+        presenceBefore = dict(self.ow.presenceCounts)
+        slots = self.ow.slots
+        echoErrors = self.ow.echoErrors
+        reads = crcErrors = missing = 0
+        failed = {}
+
+        for device in registry.sweep():
+            reads += 1
+            if isinstance(device.error, onewire.BadCRC):
+                crcErrors += 1
+            elif device.error is not None:
+                missing += 1
+            failed[device.id] = device.error is not None
+            yield device
+
+        presence = {}
+        for response, count in self.ow.presenceCounts.items():
+            count -= presenceBefore.get(response, 0)
+            if count:
+                presence[response] = count
+
+        self.record(presence, self.ow.slots - slots,
+                    self.ow.echoErrors - echoErrors, reads, crcErrors,
+                    missing, failed)
+
+    def deviceFaults(self, failed):
+        """
+        Update the faulty devices from a dict with deviceID: True if the
+        device failed in the last sweep. Return the number of failures in
+        the sweep that are due to faulty devices.
+        """
+        faultyErrors = 0
+        for deviceID, hasFailed in failed.items():
+            if not hasFailed:
+                self.failedAt.pop(deviceID, None)
+                if deviceID in self.faults:
+                    self.faults.discard(deviceID)
+                    logging.warning('Device %016x works again', deviceID)
+                continue
+
+            if deviceID in self.faults:
+                faultyErrors += 1
+                continue
+
+            profilesFailed = self.failedAt.setdefault(deviceID, set())
+            profilesFailed.add(self.profile)
+            if len(profilesFailed) == len(profiles):
+                self.faults.add(deviceID)
+                faultyErrors += 1
+                logging.warning('Device %016x fails at all profiles. '
+                                'Ignoring it for the bus health', deviceID)
+        return faultyErrors
+
+    def record(self, presence, slots, echoErrors, reads, crcErrors,
+               missing, failed = None):
+        """
+        Record the result of one sweep and change profile if needed.
+
+        failed is an optional dict with deviceID: True if the device failed
+        in the sweep, used to tell faulty devices from a faulty bus.
+        """
+        self.history.append((time.time(), profiles[self.profile][0],
+                             presence, slots, echoErrors, reads, crcErrors,
+                             missing))
+
+        deviceErrors = crcErrors + missing
+        if failed:
+            deviceErrors -= self.deviceFaults(failed)
+
+        echoRate = echoErrors / slots if slots else 0.0
+        crcRate = deviceErrors / reads if reads else 0.0
+
+        if echoRate > self.maxEchoRate or crcRate > self.maxCRCRate or \
+           (self.probing and (echoErrors or deviceErrors)):
+            self.cleanSweeps = 0
+            if self.probing:
+                # The faster profile did not work. Wait longer until the
+                # next attempt.
+                self.backoff = min(self.backoff * 2, self.maxBackoff)
+                self.probing = False
+            if self.profile < len(profiles) - 1:
+                self.setProfile(self.profile + 1)
+                logging.warning('Bus errors (echo %.4f, CRC %.4f). Falling '
+                                'back to profile %s', echoRate, crcRate,
+                                profiles[self.profile][0])
+            return
+
+        if echoErrors or deviceErrors:
+            # Within limits, but not clean enough to go faster
+            self.cleanSweeps = 0
+            return
+
+        self.cleanSweeps += 1
+        if self.probing:
+            if self.cleanSweeps >= self.probeAfter:
+                # The faster profile has been clean long enough
+                self.probing = False
+                self.backoff = 1
+            return
+
+        if self.profile > 0 and \
+           self.cleanSweeps >= self.probeAfter * self.backoff:
+            self.cleanSweeps = 0
+            self.probing = True
+            self.setProfile(self.profile - 1)
+            logging.info('Bus is clean. Probing profile %s',
+                         profiles[self.profile][0])
+
+    def report(self):
+        """
+        Return a summary of the sweeps in the history as a dict.
+        """
+        presence = collections.Counter()
+        slots = echoErrors = reads = crcErrors = missing = 0
+        for entry in self.history:
+            presence.update(entry[2])
+            slots += entry[3]
+            echoErrors += entry[4]
+            reads += entry[5]
+            crcErrors += entry[6]
+            missing += entry[7]
+
+        return {'profile': profiles[self.profile][0],
+                'sweeps': len(self.history),
+                'presence': dict(('%02x' % response, count)
+                                 for response, count in presence.items()),
+                'echoErrorRate': echoErrors / slots if slots else 0.0,
+                'crcErrorRate': crcErrors / reads if reads else 0.0,
+                'missingRate': missing / reads if reads else 0.0,
+                'faults': ['%016x' % deviceID
+                           for deviceID in sorted(self.faults)]}
@@ -0,0 +1,235 @@
+"""
+history.py: Recent readings of each sensor, kept in memory.
+Copyright (C) 2013 Anders Englund
+
+This file is part of RPi_UART_1-wire.
+
+RPi_UART_1-wire is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+RPi_UART_1-wire is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RPi_UART_1-wire.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Each sensor gets a ring buffer of fixed capacity holding the timestamps and
+the raw values (signed 16 bit, 1/16 degree) of its latest readings. When the
+buffer is full, the oldest reading is overwritten.
+
+The mean, min, max and slope of the whole buffer are kept up to date as
+readings are added, so asking for them does not depend on the size of the
+buffer. Only these are O(1). Statistics for only the last few seconds,
+window(), are computed by walking back from the newest reading, which costs
+O(k) in the number of readings within the window. Use the whole buffer
+statistics, with a capacity matching the period of interest, for anything
+asked for often.
+"""
+
+import collections
+import math
+from array import array
+
+
+class RingBuffer:
+    def __init__(self, capacity = 3600, scale = 1 / 16):
+        """
+        scale converts raw values to the unit returned by the statistics,
+        degrees for a DS18B20.
+        """
+        self.capacity = capacity
+        self.scale = scale
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('h', bytes(2 * capacity))
+
+        # Number of readings added so far. The newest reading is at
+        # (added - 1) % capacity.
+        self.added = 0
+
+        # Indexes (in added order) of candidates for min and max
+        self.minimums = collections.deque()
+        self.maximums = collections.deque()
+
+        self.resum()
+
+    def __len__(self):
+        return min(self.added, self.capacity)
+
+    def resum(self):
+        """
+        Recalculate the running statistics from the content of the buffer.
+        Done now and then to get rid of rounding errors from removing old
+        readings.
+        """
+        n = len(self)
+        self.sumV = sum(self.values[:n])     # Exact, the values are ints
+        self.meanT = sum(self.times[:n]) / n if n else 0.0
+        meanV = self.sumV / n if n else 0.0
+
+        # Sum of squared time deviations, and of time and value co-deviations
+        self.squaresT = self.productsTV = 0.0
+        for i in range(n):
+            dt = self.times[i] - self.meanT
+            self.squaresT += dt * dt
+            self.productsTV += dt * (self.values[i] - meanV)
+
+    def append(self, timestamp, raw):
+        """
+        Add a reading, overwriting the oldest one if the buffer is full.
+        """
+        index = self.added % self.capacity
+        n = len(self)
+        resum = False
+        if n == self.capacity == 1:
+            self.meanT = self.sumV = self.squaresT = self.productsTV = 0
+            n = 0
+        elif n == self.capacity:
+            # Remove the oldest reading (Welford's update, backwards)
+            t = self.times[index]
+            v = self.values[index]
+            squaresT = self.squaresT
+            dt = t - self.meanT
+            dv = v - self.sumV / n
+            self.meanT -= dt / (n - 1)
+            self.sumV -= v
+            self.squaresT -= dt * (t - self.meanT)
+            self.productsTV -= dt * (v - self.sumV / (n - 1))
+            n -= 1
+
+            # Removing a reading far from the others loses the precision
+            # of what is left.
+            resum = self.squaresT < squaresT * 1e-6
+
+        # Add the new reading (Welford's update)
+        dt = timestamp - self.meanT
+        self.meanT += dt / (n + 1)
+        self.sumV += raw
+        self.squaresT += dt * (timestamp - self.meanT)
+        self.productsTV += dt * (raw - self.sumV / (n + 1))
+
+        self.times[index] = timestamp
+        self.values[index] = raw
+
+        # Drop candidates that have left the buffer, or can never be the
+        # min or max again now that this reading has arrived.
+        oldest = self.added - self.capacity
+        if self.minimums and self.minimums[0] <= oldest:
+            self.minimums.popleft()
+        while self.minimums and \
+              self.values[self.minimums[-1] % self.capacity] >= raw:
+            self.minimums.pop()
+        self.minimums.append(self.added)
+
+        if self.maximums and self.maximums[0] <= oldest:
+            self.maximums.popleft()
+        while self.maximums and \
+              self.values[self.maximums[-1] % self.capacity] <= raw:
+            self.maximums.pop()
+        self.maximums.append(self.added)
+
+        self.added += 1
+        if resum or self.added % self.capacity == 0:
+            self.resum()
+
+    def mean(self):
+        if not len(self):
+            return math.nan
+        return self.sumV / len(self) * self.scale
+
+    def minimum(self):
+        if not len(self):
+            return math.nan
+        return self.values[self.minimums[0] % self.capacity] * self.scale
+
+    def maximum(self):
+        if not len(self):
+            return math.nan
+        return self.values[self.maximums[0] % self.capacity] * self.scale
+
+    def slope(self):
+        """
+        Return the least squares slope of the readings, per second.
+        """
+        if len(self) < 2 or self.squaresT <= 0:
+            return math.nan
+        return self.productsTV / self.squaresT * self.scale
+
+    def latest(self):
+        """
+        Return (timestamp, value) of the newest reading, or None.
+        """
+        if not len(self):
+            return None
+        index = (self.added - 1) % self.capacity
+        return self.times[index], self.values[index] * self.scale
+
+    def window(self, seconds):
+        """
+        Return (count, mean, min, max, slope) of the readings from the last
+        seconds, counted from the newest reading.
+
+        Unlike the statistics of the whole buffer, this walks through the
+        readings in the window each time.
+        """
+        if not len(self):
+            return 0, math.nan, math.nan, math.nan, math.nan
+
+        newest = self.times[(self.added - 1) % self.capacity]
+        n = 0
+        sumT = sumV = sumTT = sumTV = 0.0
+        least = most = None
+        for i in range(self.added - 1, self.added - 1 - len(self), -1):
+            index = i % self.capacity
+            # Relative to the newest reading to keep the precision
+            t = self.times[index] - newest
+            if t < -seconds:
+                break
+            v = self.values[index]
+            n += 1
+            sumT += t
+            sumV += v
+            sumTT += t * t
+            sumTV += t * v
+            least = v if least is None else min(least, v)
+            most = v if most is None else max(most, v)
+
+        denominator = n * sumTT - sumT * sumT
+        slope = (n * sumTV - sumT * sumV) / denominator * self.scale \
+            if n > 1 and denominator > 0 else math.nan
+        return (n, sumV / n * self.scale, least * self.scale,
+                most * self.scale, slope)
+
+
+class SensorHistory:
+    """
+    One ring buffer per ROM ID.
+    """
+    def __init__(self, capacity = 3600, scale = 1 / 16):
+        self.capacity = capacity
+        self.scale = scale
+        self.buffers = {}
+
+    def add(self, deviceID, value, timestamp):
+        """
+        Add a reading in degrees. Failed readings (NaN) are not added.
+        """
+        if math.isnan(value):
+            return
+
+        buffer = self.buffers.get(deviceID)
+        if buffer is None:
+            buffer = RingBuffer(self.capacity, self.scale)
+            self.buffers[deviceID] = buffer
+        buffer.append(timestamp, int(round(value / self.scale)))
+
+    def get(self, deviceID):
+        """
+        Return the ring buffer of a sensor, or None.
+        """
+        return self.buffers.get(deviceID)
@@ -21,11 +21,9 @@ You should have received a copy of the GNU General Public License
 along with RPi_UART_1-wire.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import serial
 import logging
-from datetime import datetime
+import time
 
-import simulator
 from enum import enum
 
 # Define the used port below
@@ -72,18 +70,27 @@ class OneWire():
     """
     Implementation of various 1-wire functions
     """
-    def __init__(self, simulated = False):
+    def __init__(self, simulated = False, port = usedSerialPort):
+        # Only import the transport that is used. Configuring logging is
+        # left to the application.
         if simulated:
+            import simulator
             self.uart = simulator.UART()
         else:
-            self.uart = serial.Serial(port = usedSerialPort, timeout = 0.05)
-
-        logging.basicConfig(format='%(asctime)s %(message)s',
-                            level=logging.WARNING)
+            import serial
+            self.uart = serial.Serial(port = port, timeout = 0.05)
 
         # Make sure we have no data in the UART buffer
-        while self.uart.read(1):
-            logging.info('Read some data when opening UART initially')
+        self.uart.reset_input_buffer()
+
+        # Number of slots written to the UART in one go. Larger batches are
+        # faster, but give the bus less time to recover between slots.
+        self.batchSize = 1
+
+        # Statistics used to monitor the health of the bus
+        self.presenceCounts = {}  # Reset response: count
+        self.slots = 0
+        self.echoErrors = 0
 
 
     def prepareForReset(self):
@@ -100,6 +107,58 @@ class OneWire():
 
 
 
+    def writeAndReadBytes(self, data):
+        """
+        Write a number of slots on the bus in one go, and return the read
+        bytes.
+        """
+        self.uart.write(data)
+        logging.debug('Wrote %r', data)
+
+        response = self.uart.read(len(data))
+        logging.debug('Read %r', response)
+
+        if len(response) < len(data):
+            raise BadWiring('Read %d bytes, but wrote %d. Is both TX and RX '
+                            'connected to the 1-wire bus?'
+                            % (len(response), len(data)))
+
+        return response
+
+    def checkEcho(self, sent, received):
+        """
+        Count the slots where the read byte could not have been caused by
+        the written byte. A written zero must be read as a zero. A written
+        0xFF may only have been pulled low by a device from the start bit
+        and on, ie 0xFF, 0xFE, 0xFC and so on.
+        """
+        self.slots += len(sent)
+        for byte, echo in zip(sent, received):
+            if byte == 0x00:
+                bad = echo != 0x00
+            else:
+                low = ~echo & 0xFF
+                bad = (low & (low + 1)) != 0
+            if bad:
+                self.echoErrors += 1
+                logging.info('Wrote %02x but read %02x', byte, echo)
+
+    def writeAndReadSlots(self, data):
+        """
+        Write the slots in data, batchSize at a time, and return the read
+        bytes.
+        """
+        self.prepareForSignalling()
+
+        response = b''
+        for start in range(0, len(data), self.batchSize):
+            batch = data[start:start + self.batchSize]
+            echo = self.writeAndReadBytes(batch)
+            self.checkEcho(batch, echo)
+            response += echo
+
+        return response
+
     def writeAndReadByte(self, byte):
         """
         Write a byte on the bus, read the response and return the read byte.
@@ -107,12 +166,12 @@ class OneWire():
         data = b''.fromhex('%02x' % byte) # Ugly
 
         self.uart.write(data)
-        logging.info('Wrote ' + str(data))
+        logging.info('Wrote %s', data)
 
         # Read the result. We should only receive one byte, but read more
         # in case something strange has happened.
         response = self.uart.read(1)
-        logging.info('Read ' + str(response))
+        logging.info('Read %s', response)
 
         if not response:
             raise BadWiring('Did not read any serial data on reset(). Is '
@@ -150,6 +209,9 @@ class OneWire():
         # zeroes if we have devices on the bus.
         response = self.writeAndReadByte(0xF0)
 
+        # Keep the shape of the presence pulse (see doc/timing.md)
+        self.presenceCounts[response] = self.presenceCounts.get(response, 0) + 1
+
         return response < 0xF0
 
     def sendBits(self, bits):
@@ -164,17 +226,9 @@ class OneWire():
         the receiving devices will sample the bit somewhere around the first
         bit sent.
         """
-        self.prepareForSignalling()
-
-        for bit in bits:
-            if bit:
-                # Write all ones. The receiving device will sample a one.
-                # Discard the read byte
-                self.writeAndReadByte(0xFF)
-            else:
-                # Write all zeroes. The receiving device will sample a zero
-                # Discard the read byte
-                self.writeAndReadByte(0x00)
+        # Write all ones to make the receiving device sample a one, and all
+        # zeroes to make it sample a zero. Discard the read bytes.
+        self.writeAndReadSlots(bytes(0xFF if bit else 0x00 for bit in bits))
 
     def sendByte(self, byte):
         """
@@ -220,22 +274,15 @@ class OneWire():
         If the read byte is FF, a one was sent and if it is anything lower a
         zero was sent.
         """
-        self.prepareForSignalling()
-
-        response = self.writeAndReadByte(0xFF)
-
-
-        return response == 0xFF
+        return self.readBits(1)[0]
 
     def readBits(self, numberOfBits):
         """
         Read a number of bits from the bus
         """
-        bits = []
-        for i in range(numberOfBits):
-            bits.append(self.readBit())
+        response = self.writeAndReadSlots(b'\xff' * numberOfBits)
 
-        return bits
+        return [byte == 0xFF for byte in response]
 
     def readByte(self):
         """
@@ -243,13 +290,7 @@ class OneWire():
 
         Bits are sent least significant first.
         """
-        bits = self.readBits(8)
-        byte = 0
-        for i in range(8):
-            if bits[i]:
-                byte +=  (2**i)
-
-        return byte
+        return self.readBytes(1)[0]
 
     def readBytes(self, numberOfBytes, reverse = False):
         """
@@ -258,9 +299,15 @@ class OneWire():
         The first byte read from the bus is placed first in the return
         array, unless reverse == True
         """
+        bits = self.readBits(8 * numberOfBytes)
+
         response = []
-        for i in range(numberOfBytes):
-            response.append(self.readByte())
+        for first in range(0, len(bits), 8):
+            byte = 0
+            for i in range(8):
+                if bits[first + i]:
+                    byte +=  (2**i)
+            response.append(byte)
 
         if reverse:
             response.reverse()
@@ -447,80 +494,307 @@ class OneWire():
     def getCRC(self):
         return self.shiftReg
 
+    def crc8(self, data):
+        """
+        Calculate the CRC of a list of bytes. If the last byte is the CRC
+        of the bytes before it, the result is zero.
+        """
+        self.clearCRC()
+        for byte in data:
+            for i in range(8):
+                self.CRC((byte >> i) & 1)
+
+        return self.getCRC()
+
+    def select(self, deviceID = None):
+        """
+        Reset the bus and address one device, or all devices if deviceID
+        is None. Returns False if no device responded to the reset.
+        """
+        if not self.reset():
+            return False
+
+        if deviceID is None:
+            self.sendByte(commands.SKIPROM)
+        else:
+            self.sendByte(commands.MATCHROM)
+            self.sendInt(deviceID, 64)
+
+        return True
+
+
+class OWDevice:
+    """
+    Base class of the device drivers, and the driver of devices in families
+    without a driver of their own.
+
+    A driver object is meant to live as long as the device is on the bus.
+    The slots needed to address the device are encoded once, and the last
+    reading is stored in the object by update().
+    """
+    __slots__ = ('ow', 'id', 'selectSlots', 'value', 'timestamp', 'error')
+
+    # True for drivers that have something to read in update()
+    readable = False
 
-class DS18B20:
     def __init__(self, onewire, id):
         self.ow = onewire
         self.id = id
 
-    def readTemp(self, checkCRC = False):
+        # MATCHROM followed by the ROM ID, in the order they are sent, as
+        # the bytes written to the UART for the slots (see sendBits)
+        command = commands.MATCHROM
+        bits = ([(command >> i) & 1 for i in range(8)] +
+                [(id >> i) & 1 for i in range(64)])
+        self.selectSlots = bytes(0xFF if bit else 0x00 for bit in bits)
 
-        #
-        # Start temperature conversion
-        #
-        self.ow.reset()
+        self.value = None
+        self.timestamp = None
+        self.error = None
 
-        # Address the correct device
-        self.ow.sendByte(commands.MATCHROM)
-        self.ow.sendInt(self.id, 64)
+    def select(self):
+        """
+        Reset the bus and address this device. Returns False if no device
+        responded to the reset.
+        """
+        if not self.ow.reset():
+            return False
+
+        self.ow.writeAndReadSlots(self.selectSlots)
+        return True
+
+    def update(self):
+        """
+        Read the device and store the result in value and timestamp. If the
+        reading fails, the exception is stored in error.
+        """
+        pass
+
+
+class DS18B20(OWDevice):
+    __slots__ = ('checkCRC',)
+
+    readable = True
+
+    def __init__(self, onewire, id, checkCRC = True):
+        OWDevice.__init__(self, onewire, id)
+
+        # Used by update()
+        self.checkCRC = checkCRC
+
+    @staticmethod
+    def convertAll(ow):
+        """
+        Start a temperature conversion in all devices on the bus at once
+        and wait for them to finish. Returns False if no device responded.
+        """
+        if not ow.select():
+            return False
+
+        ow.sendByte(commands.CONVERTTEMP)
+        DS18B20.waitForConversion(ow)
+
+        return True
+
+    @staticmethod
+    def waitForConversion(ow):
+        """
+        Wait for the addressed devices to finish converting. Only works for
+        externally powered devices.
+        """
+        while ow.readBit() == False:
+            pass
+
+    @staticmethod
+    def rawToCelsius(lsb, msb):
+        """
+        Convert the two temperature bytes of the scratchpad to degrees.
+        The value is a signed 16 bit integer in units of 1/16 degree.
+        """
+        raw = lsb + msb * 0x100
+        if raw & 0x8000:
+            raw -= 0x10000
+        return raw / 16
+
+    def startConversion(self):
+        """
+        Start a temperature conversion without waiting for it to finish.
+        """
+        if not self.select():
+            raise CommError('No device responded to reset')
 
         # Send command convert temperature
         self.ow.sendByte(commands.CONVERTTEMP)
 
+    def readScratchpad(self, checkCRC = True):
+        """
+        Read the scratchpad and return it as a list of ints.
+
+        If checkCRC is True, all nine bytes are read and the CRC is
+        verified. Otherwise, only the two temperature bytes are read.
+        """
+        if not self.select():
+            raise CommError('No device responded to reset')
+
+        # Send command 'Read Scratchpad'
+        self.ow.sendByte(commands.RSCRATCHPAD)
+
+        if not checkCRC:
+            # Read the first two bytes (which is the temperature)
+            return self.ow.readBytes(2)
+
+        scratchpad = self.ow.readBytes(9)
+        if self.ow.crc8(scratchpad):
+            raise BadCRC('Bad CRC when reading temperature')
+
+        return scratchpad
+
+    def readTemp(self, checkCRC = False):
+
+        #
+        # Start temperature conversion
+        #
+        self.startConversion()
+
         # Wait for conversion to finish.
-        while self.ow.readBit() == False:
-            pass
+        self.waitForConversion(self.ow)
 
         #
         # Read the temperature
         #
-        self.ow.reset()
+        temp = self.readScratchpad(checkCRC)
 
-        # Address the correct device
-        self.ow.sendByte(commands.MATCHROM)
-        self.ow.sendInt(self.id, 64)
+        return self.rawToCelsius(temp[0], temp[1])
+
+    def update(self):
+        try:
+            self.value = self.readTemp(self.checkCRC)
+            self.error = None
+        except (BadCRC, CommError) as e:
+            self.value = float('nan')
+            self.error = e
+        self.timestamp = time.time()
+
+
+# Drivers for each family code, the lowest byte of the ROM ID. Add drivers
+# for other families here.
+drivers = {0x28: DS18B20}
 
-        # Send command 'Read Scratchpad'
-        self.ow.sendByte(commands.RSCRATCHPAD)
 
-        # Read the first two bytes (which is the temperature)
-        temp = self.ow.readBytes(2)
+class DeviceRegistry:
+    """
+    Holds one driver object for each device on a bus.
+    """
+    def __init__(self, onewire, devices = None):
+        """
+        devices is a list of ROM IDs. If it is None, the bus is searched.
+        """
+        self.ow = onewire
+        if devices is None:
+            devices = onewire.search()
+
+        # deviceID: driver object
+        self.devices = {}
 
-        if checkCRC:
-            theRest = self.ow.readBytes(6)
-            crc = self.ow.readBytes(1)
+        # The driver objects that have something to read
+        self.readable = []
 
-            self.ow.clearCRC()
-            for byte in temp + theRest + crc:
-                for i in range(8):
-                    bit = ((byte >> i) & 1)
-                    self.ow.CRC(bit)
+        for deviceID in devices:
+            self.add(deviceID)
 
-            if self.ow.getCRC():
-                raise BadCRC('Bad CRC when reading temperature')
+    def add(self, deviceID):
+        """
+        Create the driver object of a device, unless it already exists.
+        """
+        device = self.devices.get(deviceID)
+        if device is None:
+            driver = drivers.get(deviceID & 0xFF, OWDevice)
+            device = driver(self.ow, deviceID)
+            self.devices[deviceID] = device
+            if device.readable:
+                self.readable.append(device)
+        return device
+
+    def family(self, familyCode):
+        """
+        Return a list of the driver objects in a family.
+        """
+        return [device for device in self.devices.values()
+                if (device.id & 0xFF) == familyCode]
 
-        temperature = (temp[0] + temp[1] * 0x100) / 16
-        return temperature
+    def sweep(self):
+        """
+        Update all readable devices, yielding each one after its update.
+        """
+        for device in self.readable:
+            device.update()
+            yield device
 
 if __name__ == '__main__':
-    import time
+    from datetime import datetime
+    logging.basicConfig(format='%(asctime)s %(message)s',
+                        level=logging.WARNING)
     o = OneWire()
     print('Searching for devices')
-    devices = o.search()
-
-    for d in devices:
-        print('  %02x'%d)
+    registry = DeviceRegistry(o)
+
+    for device in registry.devices.values():
+        print('  %02x %s' % (device.id, type(device).__name__))
+
+    import readings
+    import deadband
+    import rollup
+    import health
+    import profiling
+    import history
+    monitor = health.BusHealth(o)
+
+    # Profile a number of sweeps on SIGUSR1 or when profile-now is created
+    profiler = profiling.Profiler()
+    profiler.install()
+    # Room for all sensors found, with some to spare
+    table = readings.ReadingsTable(capacity = len(registry.readable) + 16)
+    rollups = rollup.RollupIndex()
+
+    # About the last hour of readings of each sensor, for alarms and
+    # exporters. Each sensor is read once per sweep, and a sweep takes one
+    # second of sleep and up to 0.75 s of conversion per sensor.
+    sweepPeriod = max(1, len(registry.readable)) * 1.75
+    recent = history.SensorHistory(capacity = int(3600 / sweepPeriod) + 1)
+
+    # Pass on unchanged readings every ten minutes
+    changes = deadband.DeadbandFilter(maxInterval = 600)
 
     f = open('templog.txt','at')
     while True:
-        for d in devices:
-            if (d & 0xFF) == 0x28:
-                #DS18B20
-                t = DS18B20(o, d).readTemp()
-                msg =  ('%s %016x %f' % (datetime.now().isoformat(), d,t))
+        profiler.beforeSweep()
+        for device in monitor.sweep(registry):
+            d = device.id
+            t = device.value
+            if device.error is None:
+                state = readings.status.OK
+            elif isinstance(device.error, BadCRC):
+                state = readings.status.BADCRC
+            else:
+                state = readings.status.COMMERROR
+
+            # Publish and roll up all readings, so that the table always
+            # holds the latest value and status. Only the log is filtered.
+            try:
+                table.update(d, t, state, device.timestamp)
+            except readings.TableFull as e:
+                logging.warning(str(e))
+            rollups.add(d, t, device.timestamp)
+            recent.add(d, t, device.timestamp)
+
+            if changes.accept(d, t, device.timestamp) and \
+               state == readings.status.OK:
+                msg =  ('%s %016x %f' %
+                        (datetime.now().isoformat(), d,t))
                 print(msg)
                 f.write(msg + '\n')
                 f.flush()
-                time.sleep(1)
+            time.sleep(1)
+        profiler.afterSweep()
 
 
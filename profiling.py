@@ -0,0 +1,198 @@
+"""
+profiling.py: Profile a running poller on demand.
+Copyright (C) 2013 Anders Englund
+
+This file is part of RPi_UART_1-wire.
+
+RPi_UART_1-wire is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+RPi_UART_1-wire is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RPi_UART_1-wire.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+A profiling session is started in a running poller by sending it SIGUSR1,
+or by creating the control file. The control file may contain the number of
+sweeps to profile.
+
+During the session, the poller runs under cProfile and tracemalloc, and the
+time spent in each phase of the bus traffic (reset, select, convert and
+read) is traced. When the session ends, three files are written to the
+profile directory, named after the start time of the session:
+`
+<time>.prof         cProfile stats, read them with pstats
+<time>.tracemalloc  tracemalloc snapshot, read it with Snapshot.load()
+<time>.phases       One line per operation: phase, start, total and own time
+`
+When no session is running, the only cost is checking a flag and the
+control file once per sweep.
+"""
+
+import cProfile
+import logging
+import os
+import signal
+import time
+import tracemalloc
+
+import onewire
+
+# Class, method and phase of the operations that are traced
+tracedMethods = ((onewire.OneWire, 'reset', 'reset'),
+                 (onewire.OneWire, 'select', 'select'),
+                 (onewire.OWDevice, 'select', 'select'),
+                 (onewire.DS18B20, 'convertAll', 'convert'),
+                 (onewire.DS18B20, 'startConversion', 'convert'),
+                 (onewire.DS18B20, 'waitForConversion', 'convert'),
+                 (onewire.DS18B20, 'readScratchpad', 'read'))
+
+
+class PhaseTrace:
+    """
+    Times the traced methods while installed. The own time of an operation
+    does not include the operations it calls, so that for instance the
+    reset done by select is only counted as reset.
+    """
+    def __init__(self):
+        # (phase, start, total time, own time)
+        self.operations = []
+        self.stack = []
+        self.originals = []
+
+    def wrap(self, function, phase):
+        def traced(*args, **kwargs):
+            start = time.perf_counter()
+            self.stack.append(0.0)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                total = time.perf_counter() - start
+                inner = self.stack.pop()
+                if self.stack:
+                    self.stack[-1] += total
+                self.operations.append((phase, start, total, total - inner))
+        return traced
+
+    def install(self):
+        for cls, name, phase in tracedMethods:
+            original = cls.__dict__[name]
+            self.originals.append((cls, name, original))
+            if isinstance(original, staticmethod):
+                setattr(cls, name,
+                        staticmethod(self.wrap(original.__func__, phase)))
+            else:
+                setattr(cls, name, self.wrap(original, phase))
+
+    def uninstall(self):
+        for cls, name, original in reversed(self.originals):
+            setattr(cls, name, original)
+        self.originals = []
+
+    def totals(self):
+        """
+        Return a dict with phase: (count, own time)
+        """
+        totals = {}
+        for phase, start, total, own in self.operations:
+            count, spent = totals.get(phase, (0, 0.0))
+            totals[phase] = (count + 1, spent + own)
+        return totals
+
+    def write(self, path):
+        with open(path, 'wt') as f:
+            for phase, (count, own) in sorted(self.totals().items()):
+                f.write('# %-8s %6d operations %10.6f s\n' %
+                        (phase, count, own))
+            for phase, start, total, own in self.operations:
+                f.write('%-8s %.6f %.6f %.6f\n' % (phase, start, total, own))
+
+
+class Profiler:
+    def __init__(self, directory = 'profiles', sweeps = 10,
+                 controlFile = 'profile-now'):
+        self.directory = directory
+        self.sweeps = sweeps
+        self.controlFile = controlFile
+
+        self.requested = 0
+        self.remaining = 0
+        self.profile = None
+
+    def install(self, signum = signal.SIGUSR1):
+        """
+        Start a session when the process receives signum.
+        """
+        signal.signal(signum, self.request)
+
+    def request(self, signum = None, frame = None, sweeps = None):
+        """
+        Ask for a session to start at the next sweep. Safe to call from a
+        signal handler.
+        """
+        self.requested = sweeps or self.sweeps
+
+    def checkControlFile(self):
+        if not self.controlFile or not os.path.exists(self.controlFile):
+            return
+
+        try:
+            with open(self.controlFile) as f:
+                sweeps = int(f.read().strip() or 0)
+        except ValueError:
+            sweeps = 0
+        os.remove(self.controlFile)
+        self.request(sweeps = sweeps)
+
+    def beforeSweep(self):
+        """
+        Call before each sweep.
+        """
+        if not self.profile:
+            self.checkControlFile()
+            if self.requested:
+                self.start(self.requested)
+
+    def afterSweep(self):
+        """
+        Call after each sweep.
+        """
+        if self.profile:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.stop()
+
+    def start(self, sweeps):
+        logging.warning('Profiling %d sweeps', sweeps)
+        self.requested = 0
+        self.remaining = sweeps
+        self.name = time.strftime('%Y%m%d-%H%M%S')
+
+        self.trace = PhaseTrace()
+        self.trace.install()
+        tracemalloc.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        self.trace.uninstall()
+
+        os.makedirs(self.directory, exist_ok = True)
+        base = os.path.join(self.directory, self.name)
+        self.profile.dump_stats(base + '.prof')
+        snapshot.dump(base + '.tracemalloc')
+        self.trace.write(base + '.phases')
+        logging.warning('Wrote profile to %s.*', base)
+
+        self.profile = None
+        self.trace = None
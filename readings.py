@@ -0,0 +1,250 @@
+"""
+readings.py: A shared memory table of the latest 1-wire readings.
+Copyright (C) 2013 Anders Englund
+
+This file is part of RPi_UART_1-wire.
+
+RPi_UART_1-wire is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+RPi_UART_1-wire is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RPi_UART_1-wire.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+This module lets the process polling the bus publish the latest value,
+timestamp and status of every device in a memory mapped file. Any number of
+other processes can then read the current values without opening the UART
+or parsing the log file.
+
+The file has a fixed layout:
+`
+Header (32 bytes): magic 'OWRT', version, capacity, count, padding
+Slot   (32 bytes): sequence, status, deviceID, timestamp, value
+`
+Each slot is protected by a sequence lock. The writer makes the sequence
+odd before changing the slot and even again when it is done. A reader
+retries until it has read the same even sequence before and after copying
+the slot.
+"""
+
+import mmap
+import os
+import struct
+import time
+
+from enum import enum
+
+# Define the default location of the table below. /dev/shm is a RAM disk
+# on the raspberry, so the table never touches the SD card.
+defaultPath = '/dev/shm/onewire-readings'
+
+status = enum(OK=0,
+              BADCRC=1,
+              COMMERROR=2)
+
+MAGIC = b'OWRT'
+VERSION = 1
+
+header = struct.Struct('<4sIII16x')   # magic, version, capacity, count
+slot = struct.Struct('<IiQdd')        # seq, status, deviceID, time, value
+sequence = struct.Struct('<I')
+
+class TableFull(Exception): pass
+class BadTable(Exception): pass
+class TableBusy(Exception): pass
+
+
+class ReadingsTable:
+    """
+    The writing side of the table. There should only be one writer per file.
+    """
+    def __init__(self, path = defaultPath, capacity = 64):
+        self.path = path
+        self.capacity = capacity
+        size = header.size + capacity * slot.size
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Reuse the file in place so that readers that already have it
+            # mapped will see the new content. Never shrink it, a reader
+            # touching a page beyond the end of the file gets SIGBUS. The
+            # capacity in the header limits what is used.
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        # Clear all slots, but keep bumping their sequence numbers so that
+        # a reader in the middle of a read notices.
+        for index in range(capacity):
+            offset = self.slotOffset(index)
+            seq = sequence.unpack_from(self.map, offset)[0]
+            slot.pack_into(self.map, offset, (seq | 1) + 1, 0, 0, 0.0, 0.0)
+
+        header.pack_into(self.map, 0, MAGIC, VERSION, capacity, 0)
+        self.index = {}
+
+    def slotOffset(self, index):
+        return header.size + index * slot.size
+
+    def update(self, deviceID, value, state = status.OK, timestamp = None):
+        """
+        Publish a new reading for a device.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        index = self.index.get(deviceID)
+        isNew = index is None
+        if isNew:
+            index = len(self.index)
+            if index >= self.capacity:
+                raise TableFull('No room for device %016x in %s'
+                                % (deviceID, self.path))
+
+        offset = self.slotOffset(index)
+        seq = sequence.unpack_from(self.map, offset)[0]
+
+        sequence.pack_into(self.map, offset, seq + 1) # Odd: writing
+        slot.pack_into(self.map, offset, seq + 1, state, deviceID,
+                       timestamp, value)
+        sequence.pack_into(self.map, offset, seq + 2) # Even: done
+
+        if isNew:
+            # Only announce the slot once it holds a complete reading
+            self.index[deviceID] = index
+            header.pack_into(self.map, 0, MAGIC, VERSION, self.capacity,
+                             len(self.index))
+
+    def close(self):
+        self.map.close()
+
+
+class ReadingsReader:
+    """
+    The reading side of the table. Any number of readers may be used.
+    """
+    def __init__(self, path = defaultPath, timeout = 0.1):
+        """
+        timeout is how long to wait for the writer to finish a slot before
+        giving up with TableBusy.
+        """
+        self.path = path
+        self.timeout = timeout
+        self.file = open(path, 'rb')
+        self.map = None
+        self.remap()
+
+    def remap(self):
+        """
+        Map the file again, for instance after the writer was restarted with
+        another capacity.
+        """
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+        size = os.fstat(self.file.fileno()).st_size
+        if size < header.size:
+            raise BadTable('%s is too small to be a readings table'
+                           % self.path)
+        self.map = mmap.mmap(self.file.fileno(), size,
+                             access = mmap.ACCESS_READ)
+
+        magic, version, self.capacity, count = header.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise BadTable('%s is not a readings table' % self.path)
+        if size < header.size + self.capacity * slot.size:
+            raise BadTable('%s is smaller than its capacity' % self.path)
+
+        self.index = {}
+
+    def checkMapping(self):
+        """
+        Make sure the mapping matches the size of the file, so that no slot
+        is read beyond the end of it.
+        """
+        capacity = header.unpack_from(self.map, 0)[2]
+        if capacity != self.capacity or \
+           os.fstat(self.file.fileno()).st_size != len(self.map):
+            self.remap()
+
+    def count(self):
+        count = header.unpack_from(self.map, 0)[3]
+        if count > self.capacity:
+            raise BadTable('%s has %d slots in use, but room for %d'
+                           % (self.path, count, self.capacity))
+        return count
+
+    def readSlot(self, index):
+        """
+        Read a consistent copy of a slot.
+
+        Returns (deviceID, value, timestamp, status)
+        """
+        offset = header.size + index * slot.size
+        deadline = None
+        while True:
+            seq, state, deviceID, timestamp, value = slot.unpack_from(
+                self.map, offset)
+            if not seq & 1 and sequence.unpack_from(self.map, offset)[0] == seq:
+                return deviceID, value, timestamp, state
+
+            # The writer is busy with this slot, or died while writing it
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + self.timeout
+            elif now > deadline:
+                raise TableBusy('Slot %d of %s has been busy for %.3f s'
+                                % (index, self.path, self.timeout))
+            time.sleep(0)
+
+    def rescan(self):
+        self.index = {}
+        for index in range(self.count()):
+            deviceID = self.readSlot(index)[0]
+            self.index[deviceID] = index
+
+    def get(self, deviceID):
+        """
+        Return (value, timestamp, status) for a device, or None if the
+        device has not been published.
+        """
+        self.checkMapping()
+        for attempt in range(2):
+            index = self.index.get(deviceID)
+            if index is not None and index < self.capacity:
+                foundID, value, timestamp, state = self.readSlot(index)
+                if foundID == deviceID:
+                    return value, timestamp, state
+
+            # The writer may have been restarted or added devices since
+            # we last looked.
+            self.rescan()
+
+        return None
+
+    def readAll(self):
+        """
+        Return a dict with deviceID: (value, timestamp, status) for all
+        published devices.
+        """
+        self.checkMapping()
+        readings = {}
+        for index in range(self.count()):
+            deviceID, value, timestamp, state = self.readSlot(index)
+            readings[deviceID] = (value, timestamp, state)
+        return readings
+
+    def close(self):
+        self.map.close()
+        self.file.close()
@@ -0,0 +1,184 @@
+"""
+rollup.py: Minute, hour and day statistics of the readings.
+Copyright (C) 2013 Anders Englund
+
+This file is part of RPi_UART_1-wire.
+
+RPi_UART_1-wire is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+RPi_UART_1-wire is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RPi_UART_1-wire.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Answering questions like "daily min/max for the last year" from the raw log
+means reading all of it. This module keeps rollups of the readings that are
+updated as the readings arrive, so that such questions only need to read a
+few records.
+
+There is one file per sensor and level in the rollup directory, named
+<deviceID>.<level>, for instance 2b0000047ff88528.hour. Each file is a
+sequence of fixed size records, sorted by the start of the bucket:
+`
+start   int64    Start of the bucket (seconds since the epoch, UTC)
+min     float64
+max     float64
+sum     float64
+count   uint32
+`
+The record of the current bucket is rewritten in place until a reading
+arrives in the next bucket. Since the records are sorted and have a fixed
+size, a query finds its first record with a binary search.
+"""
+
+import logging
+import math
+import os
+import struct
+import time
+
+levels = (('minute', 60),
+          ('hour', 3600),
+          ('day', 86400))
+
+record = struct.Struct('<qdddI4x')
+
+
+class RollupIndex:
+    def __init__(self, directory = 'rollup'):
+        self.directory = directory
+        os.makedirs(directory, exist_ok = True)
+
+        # (deviceID, level): file descriptor
+        self.files = {}
+
+        # (deviceID, level): [start, min, max, sum, count, offset] of the
+        # last record in the file
+        self.current = {}
+
+    def path(self, deviceID, level):
+        return os.path.join(self.directory, '%016x.%s' % (deviceID, level))
+
+    def open(self, deviceID, level):
+        key = (deviceID, level)
+        fd = self.files.get(key)
+        if fd is None:
+            fd = os.open(self.path(deviceID, level), os.O_RDWR | os.O_CREAT,
+                         0o644)
+            self.files[key] = fd
+        return fd
+
+    def lastRecord(self, deviceID, level):
+        """
+        Return the last record of a file as a list, with its offset appended.
+        """
+        key = (deviceID, level)
+        last = self.current.get(key)
+        if last is None:
+            fd = self.open(deviceID, level)
+            size = os.fstat(fd).st_size
+            size -= size % record.size  # Skip a partly written record
+            if size:
+                offset = size - record.size
+                last = list(record.unpack(os.pread(fd, record.size, offset)))
+                last.append(offset)
+            self.current[key] = last
+        return last
+
+    def add(self, deviceID, value, timestamp = None):
+        """
+        Add a reading to the rollups of a sensor.
+        """
+        if math.isnan(value):
+            return
+        if timestamp is None:
+            timestamp = time.time()
+
+        for level, size in levels:
+            start = int(timestamp // size) * size
+            last = self.lastRecord(deviceID, level)
+
+            if last is None or start > last[0]:
+                # First reading in a new bucket
+                offset = last[5] + record.size if last else 0
+                last = [start, value, value, value, 1, offset]
+                self.current[(deviceID, level)] = last
+            elif start == last[0]:
+                last[1] = min(last[1], value)
+                last[2] = max(last[2], value)
+                last[3] += value
+                last[4] += 1
+            else:
+                logging.warning('Reading of %016x at %f is older than the '
+                                'last %s rollup', deviceID, timestamp, level)
+                return
+
+            os.pwrite(self.open(deviceID, level), record.pack(*last[:5]),
+                      last[5])
+
+    def chooseLevel(self, step):
+        """
+        Return the name and size of the coarsest level with buckets no
+        larger than step, or the finest level if step is smaller than all.
+        """
+        chosen = levels[0]
+        for level, size in levels:
+            if size <= step:
+                chosen = (level, size)
+        return chosen
+
+    def query(self, deviceID, start, end, step = None, maxPoints = 500):
+        """
+        Return a list of (start, min, max, mean, count) for the buckets of
+        a sensor that overlap [start, end).
+
+        The coarsest level with buckets no larger than step is used. If step
+        is None, it is chosen so that the result has about maxPoints buckets
+        or more.
+        """
+        if step is None:
+            step = (end - start) / maxPoints
+        level, size = self.chooseLevel(step)
+
+        path = self.path(deviceID, level)
+        if not os.path.exists(path):
+            return []
+
+        first = int(start // size) * size
+        with open(path, 'rb') as f:
+            count = os.fstat(f.fileno()).st_size // record.size
+
+            # Binary search for the first bucket not before first
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                f.seek(middle * record.size)
+                if record.unpack(f.read(record.size))[0] < first:
+                    low = middle + 1
+                else:
+                    high = middle
+
+            result = []
+            f.seek(low * record.size)
+            for index in range(low, count):
+                bucket, least, most, total, n = record.unpack(
+                    f.read(record.size))
+                if bucket >= end:
+                    break
+                result.append((bucket, least, most, total / n, n))
+
+        return result
+
+    def close(self):
+        for fd in self.files.values():
+            os.close(fd)
+        self.files = {}
+        self.current = {}
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+# -*- Coding: utf-8 -*-
+
+"""
+scenarios.py: Run the master against many simulated buses in parallel.
+Copyright (C) 2013 Anders Englund
+
+This file is part of RPi_UART_1-wire.
+
+RPi_UART_1-wire is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+RPi_UART_1-wire is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RPi_UART_1-wire.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Each scenario is a simulated bus of DS18B20 sensors. The runner searches the
+bus, reads all sensors once, and checks that all devices were found and all
+temperatures read correctly. It also measures the cost of the search and the
+read sweep in slots, resets and CPU time.
+
+The scenarios are run in a process pool, and the results are aggregated
+into one report with a row per layout, bit error rate and bus size, which
+gives the scaling of the search and the sweep with the size of the bus.
+
+Layouts of the ROM IDs:
+`
+random        Random serial numbers
+sharedprefix  Serial numbers that only differ in the last bits sent, which
+              is the worst case for the search
+`
+"""
+
+import collections
+import contextlib
+import logging
+import multiprocessing
+import random
+import time
+
+import onewire
+import simulator
+
+layouts = ('random', 'sharedprefix')
+
+
+def makeID(serial, family = 0x28):
+    """
+    Return a ROM ID with a correct CRC.
+    """
+    data = [family] + [(serial >> (8 * i)) & 0xFF for i in range(6)]
+    deviceID = 0
+    for i, byte in enumerate(data + [simulator.crc8(data)]):
+        deviceID |= byte << (8 * i)
+    return deviceID
+
+def makeScenarios(sizes = (1, 2, 5, 10, 20, 50, 100, 200), layouts = layouts,
+                  bitErrorRates = (0.0, 0.0001), repeats = 3, seed = 0):
+    """
+    Return a list of scenarios, one for each combination of the arguments
+    and repetition.
+    """
+    scenarios = []
+    for layout in layouts:
+        for bitErrorRate in bitErrorRates:
+            for size in sizes:
+                for repeat in range(repeats):
+                    scenarios.append({'layout': layout,
+                                      'size': size,
+                                      'bitErrorRate': bitErrorRate,
+                                      'seed': seed + len(scenarios)})
+    return scenarios
+
+def makeBus(scenario):
+    """
+    Return a simulated OneWire with the devices of a scenario attached, and
+    a dict with deviceID: temperature.
+    """
+    rng = random.Random(scenario['seed'])
+    size = scenario['size']
+
+    if scenario['layout'] == 'sharedprefix':
+        # Put the differing bits at the end of the 48 bit serial number
+        shift = 48 - max(1, (size - 1).bit_length())
+        offset = rng.getrandbits(shift)
+        serials = [offset | (n << shift) for n in range(size)]
+    else:
+        serials = set()
+        while len(serials) < size:
+            serials.add(rng.getrandbits(48))
+
+    ow = onewire.OneWire(simulated = True)
+    ow.uart.bitErrorRate = scenario['bitErrorRate']
+    ow.uart.random.seed(scenario['seed'])
+
+    temperatures = {}
+    for serial in serials:
+        deviceID = makeID(serial)
+        temperatures[deviceID] = rng.randint(-55 * 16, 125 * 16) / 16
+        ow.uart.attachOWdevice(
+            simulator.DS18B20device(deviceID, temperatures[deviceID]))
+
+    return ow, temperatures
+
+def measure(ow, function):
+    """
+    Call function and return its result, and the number of slots, resets
+    and seconds of CPU time it used.
+    """
+    slots = ow.slots
+    resets = sum(ow.presenceCounts.values())
+    cpu = time.process_time()
+
+    result = function()
+
+    return (result, ow.slots - slots,
+            sum(ow.presenceCounts.values()) - resets,
+            time.process_time() - cpu)
+
+def runScenario(scenario):
+    """
+    Run one scenario and return a dict with the scenario and its results.
+    """
+    result = dict(scenario)
+
+    # The simulator and the search print progress
+    with contextlib.redirect_stdout(None):
+        ow, temperatures = makeBus(scenario)
+
+        found, slots, resets, cpu = measure(ow, ow.search)
+        found = set(found)
+        result['missing'] = len(set(temperatures) - found)
+        result['extra'] = len(found - set(temperatures))
+        result['searchSlots'] = slots
+        result['searchResets'] = resets
+        result['searchCPU'] = cpu
+
+        registry = onewire.DeviceRegistry(ow, sorted(temperatures))
+        readings, slots, resets, cpu = measure(
+            ow, lambda: [(d.id, d.value) for d in registry.sweep()])
+        result['badReadings'] = sum(1 for deviceID, value in readings
+                                    if value != temperatures[deviceID])
+        result['sweepSlots'] = slots
+        result['sweepResets'] = resets
+        result['sweepCPU'] = cpu
+
+    return result
+
+def runAll(scenarios, processes = None):
+    """
+    Run the scenarios in a pool of processes, one per CPU unless processes
+    is given, and return the results in the order of the scenarios.
+    """
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(runScenario, scenarios, chunksize = 1)
+
+def report(results):
+    """
+    Return a text report with one row per layout, bit error rate and size.
+    Costs are means over the repetitions.
+    """
+    groups = collections.OrderedDict()
+    for result in sorted(results, key = lambda r: (r['layout'],
+                                                   r['bitErrorRate'],
+                                                   r['size'])):
+        key = (result['layout'], result['bitErrorRate'], result['size'])
+        groups.setdefault(key, []).append(result)
+
+    lines = ['%-12s %8s %5s %4s %6s %10s %7s %9s %9s %7s %9s' %
+             ('layout', 'errors', 'size', 'runs', 'ok', 'searchSlot',
+              'resets', 'searchCPU', 'sweepSlot', 'resets', 'sweepCPU')]
+    for (layout, bitErrorRate, size), group in groups.items():
+        runs = len(group)
+        ok = sum(1 for r in group if not (r['missing'] or r['extra'] or
+                                          r['badReadings']))
+        mean = lambda name: sum(r[name] for r in group) / runs
+        lines.append('%-12s %8g %5d %4d %5.0f%% %10.0f %7.0f %9.4f %9.0f '
+                     '%7.0f %9.4f' %
+                     (layout, bitErrorRate, size, runs, 100.0 * ok / runs,
+                      mean('searchSlots'), mean('searchResets'),
+                      mean('searchCPU'), mean('sweepSlots'),
+                      mean('sweepResets'), mean('sweepCPU')))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import sys
+
+    # The effects of the bit errors are counted in the results
+    logging.basicConfig(level = logging.CRITICAL)
+
+    # Give other sizes on the command line
+    sizes = [int(size) for size in sys.argv[1:]] or \
+        [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]
+
+    scenarios = makeScenarios(sizes)
+    start = time.time()
+    results = runAll(scenarios)
+    print(report(results))
+    print('%d scenarios in %.1f s' % (len(results), time.time() - start))
@@ -22,12 +22,25 @@ along with RPi_UART_1-wire.  If not, see <http://www.gnu.org/licenses/>.
 This module simulates an uart in case there is no real UART.
 
 There is also a class that can simulate a 1-wire device.
+
+The UART decodes the ROM layer (SEARCH ROM, MATCH ROM and SKIP ROM) itself,
+so that a slot costs O(log N) with N devices on the bus. Only the devices
+addressed by a ROM command are asked about the slots of the function
+command that follows. Other ROM commands are handed to every device, which
+then decode them with their own state machine.
 """
 
+import bisect
+import collections
 import random
 from enum import enum
 
-random.seed()
+def reverseBits(deviceID):
+    """
+    Return the 64 bit ID with the bit order reversed, so that bit 0, the
+    first sent in a search, is the most significant.
+    """
+    return int('{:064b}'.format(deviceID)[::-1], 2)
 
 class UART:
     baudrate = 9600
@@ -36,16 +49,40 @@ class UART:
     def __init__(self):
         # Define a buffer used for input to the uart from the serial
         # line, ie the data returned when calling read()
-        self.inputBuffer = []
+        self.inputBuffer = collections.deque()
 
         # Define an output buffer which written bytes are put into
         # at write.
-        self.outputBuffer = []
+        self.outputBuffer = collections.deque()
 
         # Define an optional list of attached 1-wire devices
         # based on the OWdevice class
         self.devices = []
 
+        # Indexes of the devices, rebuilt at a reset when self.devices has
+        # changed. byID is deviceID: list of devices. searchKeys are the bit
+        # reversed IDs in sorted order, and searchOrder the devices in the
+        # same order, so that the devices still taking part in a search are
+        # always a range of it.
+        self.indexed = []
+        self.byID = {}
+        self.searchKeys = []
+        self.searchOrder = []
+
+        # Where in the ROM layer the bus is since the last reset, see
+        # romFrame()
+        self.romState = None
+
+        # The devices addressed by the ROM command, that receive the slots
+        # of the function command. Idle devices stay idle until the next
+        # reset, so they need not be asked.
+        self.active = []
+
+        # Probability that the master reads the wrong bit in a read slot.
+        # Seed random to get the same errors every time.
+        self.bitErrorRate = 0.0
+        self.random = random.Random()
+
     def setNextReadByte(self, byte):
         assert(byte > 0)
         assert(byte < 255)
@@ -53,33 +90,53 @@ class UART:
 
     def readOutput(self):
         if self.outputBuffer:
-            byte = self.outputBuffer[0]
-            self.outputBuffer = self.outputBuffer[1:]
-            return byte
+            return self.outputBuffer.popleft()
         else:
             return None
 
     def read(self, nrBytes = 1):
-        response = b''
+        response = bytearray()
         while nrBytes > 0 and self.inputBuffer:
-            byte = self.inputBuffer[0]
-            self.inputBuffer = self.inputBuffer[1:]
-            response = response + b''.fromhex('%02x' % byte) # Ugly
+            response.append(self.inputBuffer.popleft())
+            nrBytes -= 1
+
+        return bytes(response)
 
-        return response
+    def reset_input_buffer(self):
+        self.inputBuffer.clear()
 
     def write(self, data):
         assert(type(data) == bytes)
         for byte in data:
             self.outputBuffer.append(byte)
 
-        # See if there are any devices to send to.
-        self.sendToDevices(data)
+        # See if there are any devices to send to. Each byte is a separate
+        # slot on the bus.
+        for byte in data:
+            self.sendToDevices(bytes([byte]))
 
     def attachOWdevice(self, device):
         self.devices.append(device)
         print('Attaching device %X to bus' % device.deviceID)
 
+    def indexDevices(self):
+        """
+        Rebuild the indexes of the devices if the list of devices has
+        changed, by attachOWdevice() or by changing the list directly.
+        """
+        if self.devices == self.indexed:
+            return
+
+        self.indexed = list(self.devices)
+        self.byID = {}
+        for device in self.devices:
+            self.byID.setdefault(device.deviceID, []).append(device)
+
+        keyed = sorted((reverseBits(device.deviceID), index)
+                       for index, device in enumerate(self.devices))
+        self.searchKeys = [key for key, index in keyed]
+        self.searchOrder = [self.devices[index] for key, index in keyed]
+
     def sendToDevices(self, data):
         """
         Parse data intelligently to determine what is sent (if it is reset
@@ -92,16 +149,15 @@ class UART:
             return
 
         if data == b'\xF0' and self.baudrate == 9600:
-            # We are sending a reset
-            response = True # Initiate with a high bus
-            for device in self.devices:
-                response &= device.reset() # And all devices responses
-
-            if response == False:
-                # The devices have responded. Lower a bit on the input data.
-                self.inputBuffer.append(0xE0) # One bit was lowered by devices
-            else:
-                self.inputBuffer.append(0xF0) # No change from input.
+            # We are sending a reset. All devices answer with a presence
+            # pulse, and wait for a ROM command.
+            self.indexDevices()
+            self.romState = 'command'
+            self.romBits = []
+            self.active = []
+
+            # The devices have responded. Lower a bit on the input data.
+            self.inputBuffer.append(0xE0) # One bit was lowered by devices
         elif self.baudrate == 115200:
             # We are communicating
             if data == b'\x00':
@@ -114,11 +170,25 @@ class UART:
                 raise ValueError('Can only receive 0x00 or 0xFF @ 115200 baud. '
                                  'Now received ' + str(data))
 
-            response = True # Start with high bus
-            for device in self.devices:
-                response &= device.frame(bitToSend)
-
-            if response:
+            if self.romState is not None:
+                response = self.romFrame(bitToSend)
+            else:
+                response = True # Start with high bus
+                wentIdle = False
+                for device in self.active:
+                    response &= device.frame(bitToSend)
+                    wentIdle = wentIdle or device.state is state.idle
+                if wentIdle:
+                    self.active = [device for device in self.active
+                                   if device.state is not state.idle]
+
+            if bitToSend and self.bitErrorRate and \
+               self.random.random() < self.bitErrorRate:
+                response = not response
+
+            if not bitToSend:
+                self.inputBuffer.append(0x00) # The master pulled it low.
+            elif response:
                 self.inputBuffer.append(0xFF) # All ones in reply.
             else:
                 self.inputBuffer.append(0xFE) # The first bit zero.
@@ -127,14 +197,119 @@ class UART:
             raise ValueError('Unhandled data sent on UART @ %d baud: %s'
                              % (self.baudrate, str(data)))
 
+    def romFrame(self, bit):
+        """
+        Handle a slot of the ROM layer for all devices at once, and return
+        the wired AND of their responses.
+
+        romState is 'command' while the ROM command is sent, 'match' while
+        the ID of a MATCH ROM is sent and 'search' during a SEARCH ROM. It is
+        None once the function command is reached, and the slots go to the
+        devices in self.active.
+        """
+        if self.romState == 'command':
+            self.romBits.append(bit)
+            if len(self.romBits) == 8:
+                self.startRomCommand(sum(1 << i for i, romBit
+                                         in enumerate(self.romBits)
+                                         if romBit))
+            # The devices pull the bus low in the first slot after a reset
+            return len(self.romBits) != 1
+
+        elif self.romState == 'match':
+            if bit:
+                self.matchID |= 1 << self.position
+            self.position += 1
+            if self.position == 64:
+                self.romState = None
+                self.active = self.byID.get(self.matchID, [])
+                for device in self.active:
+                    device.state = state.function
+                    device.functioncommand = []
+            return True
+
+        elif self.romState == 'search':
+            return self.searchFrame(bit)
+
+        return True # Search is over, nobody is listening
+
+    def startRomCommand(self, command):
+        if command == romcommand.match:
+            self.romState = 'match'
+            self.matchID = 0
+            self.position = 0
+        elif command == romcommand.skip:
+            self.romState = None
+            self.active = list(self.devices)
+            for device in self.active:
+                device.state = state.function
+                device.functioncommand = []
+        elif command == romcommand.search:
+            self.romState = 'search'
+            self.position = 0
+            self.searchSlot = 0
+            self.first = 0
+            self.last = len(self.searchOrder)
+        else:
+            # Let the devices decode it themselves
+            self.romState = None
+            for device in self.devices:
+                device.reset()
+                for bit in self.romBits:
+                    device.frame(bit)
+            self.active = [device for device in self.devices
+                           if device.state is not state.idle]
+
+    def searchFrame(self, bit):
+        """
+        One slot of a search. The devices still taking part are
+        searchOrder[first:last]. They share the bits before position, so
+        they are sorted on the bit at position, zeroes first.
+        """
+        if self.searchSlot == 0:
+            if not bit and self.first < self.last:
+                raise ValueError('We are in search state, but got a zero bit')
+            # First device with a one at position
+            prefix = self.searchKeys[self.first] >> (64 - self.position) \
+                << (64 - self.position) if self.first < self.last else 0
+            self.split = bisect.bisect_left(
+                self.searchKeys, prefix | (1 << (63 - self.position)),
+                self.first, self.last)
+            self.searchSlot = 1
+            # Devices with a zero pull the bus low
+            return self.split == self.first
+
+        elif self.searchSlot == 1:
+            if not bit and self.first < self.last:
+                raise ValueError('We are in search state, but got a zero bit')
+            self.searchSlot = 2
+            # The complement, devices with a one pull the bus low
+            return self.split == self.last
+
+        # The master selects the devices to continue with
+        if bit:
+            self.first = self.split
+        else:
+            self.last = self.split
+        self.position += 1
+        self.searchSlot = 0
+        if self.position == 64:
+            for device in self.searchOrder[self.first:self.last]:
+                print('%X is the found device' % device.deviceID)
+            self.romState = 'done'
+        return True
+
 
 state = enum('reset', 'romcommand', 'idle',
-             'search', 'searchcomplement', 'searchselectbit')
+             'search', 'searchcomplement', 'searchselectbit',
+             'match', 'function', 'converting', 'transmit')
 romcommand  = enum(search=0xF0,
                    read=0x33,
                    match=0x55,
                    skip=0xCC,
                    alarmsearch=0xEC)
+functioncommand = enum(convert=0x44,
+                       readscratchpad=0xBE)
 
 class OWdevice:
     """
@@ -239,6 +414,58 @@ class OWdevice:
 
             return True # Do not pull bus down
 
+        #########################################
+        #
+        # Matching the ROM ID sent by the master
+        #
+        #########################################
+        elif self.state is state.match:
+            if bool(bit) != ((self.deviceID & (2 ** self.position)) > 0):
+                # Someone else is addressed
+                self.state = state.idle
+                return True
+
+            self.position += 1
+            if self.position >= 64:
+                self.state = state.function
+                self.functioncommand = []
+            return True
+
+        #########################################
+        #
+        # Function command
+        #
+        #########################################
+        elif self.state is state.function:
+            self.functioncommand.append(bit)
+            if len(self.functioncommand) == 8:
+                self.parseFunctionCommand(
+                    self.bitsToByte(self.functioncommand))
+            return True
+
+        #########################################
+        #
+        # Converting, respond with zeroes until done
+        #
+        #########################################
+        elif self.state is state.converting:
+            if self.conversionSlots > 0:
+                self.conversionSlots -= 1
+                return False
+            return True
+
+        #########################################
+        #
+        # Transmitting data to the master
+        #
+        #########################################
+        elif self.state is state.transmit:
+            response = self.transmitBits[self.transmitted]
+            self.transmitted += 1
+            if self.transmitted == len(self.transmitBits):
+                self.state = state.idle
+            return response
+
         #########################################
         #
         # Idle
@@ -270,6 +497,80 @@ class OWdevice:
         if command == romcommand.search:
             self.state = state.search
             self.position = 0
+        elif command == romcommand.match:
+            self.state = state.match
+            self.position = 0
+        elif command == romcommand.skip:
+            self.state = state.function
+            self.functioncommand = []
         else:
             raise NotImplementedError('Cannot parse romcommand %02X yet' %
                                       command)
+
+    def parseFunctionCommand(self, command):
+        """
+        Act on a function command. Plain devices do not know any.
+        """
+        raise NotImplementedError('Cannot parse function command %02X' %
+                                  command)
+
+    def transmit(self, data):
+        """
+        Queue bytes to send to the master, least significant bit first.
+        """
+        self.transmitBits = []
+        self.transmitted = 0
+        for byte in data:
+            for i in range(8):
+                self.transmitBits.append((byte >> i) & 1 == 1)
+        self.state = state.transmit
+
+
+def crc8(data):
+    """
+    Calculate the 1-wire CRC of a list of bytes
+    """
+    crc = 0
+    for byte in data:
+        for i in range(8):
+            fb = (crc ^ (byte >> i)) & 0x01
+            crc >>= 1
+            if fb:
+                crc ^= 0x8C
+    return crc
+
+
+class DS18B20device(OWdevice):
+    """
+    A simulated DS18B20 temperature sensor. Set temperature to change what
+    is measured at the next conversion.
+
+    conversionDelay is the number of read slots the device answers with a
+    zero after a convert command. If badCRC is set, the CRC of the
+    scratchpad is corrupted.
+    """
+    def __init__(self, deviceID = None, temperature = 21.5):
+        OWdevice.__init__(self, deviceID)
+        self.temperature = temperature
+        self.conversionDelay = 0
+        self.badCRC = False
+        self.conversions = 0
+
+        # Power on value is 85 degrees
+        self.scratchpad = [0x50, 0x05, 0x4B, 0x46, 0x7F, 0xFF, 0x0C, 0x10]
+
+    def parseFunctionCommand(self, command):
+        if command == functioncommand.convert:
+            raw = int(round(self.temperature * 16)) & 0xFFFF
+            self.scratchpad[0] = raw & 0xFF
+            self.scratchpad[1] = raw >> 8
+            self.conversions += 1
+            self.conversionSlots = self.conversionDelay
+            self.state = state.converting
+        elif command == functioncommand.readscratchpad:
+            crc = crc8(self.scratchpad)
+            if self.badCRC:
+                crc ^= 0xFF
+            self.transmit(self.scratchpad + [crc])
+        else:
+            OWdevice.parseFunctionCommand(self, command)
@@ -0,0 +1,234 @@
+"""
+sweep.py: Read all temperature sensors on a bus into one NumPy array.
+Copyright (C) 2013 Anders Englund
+
+This file is part of RPi_UART_1-wire.
+
+RPi_UART_1-wire is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+RPi_UART_1-wire is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with RPi_UART_1-wire.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+A sweep starts one conversion in all devices on the bus, and then reads the
+scratchpad of each sensor. A StaggeredSweep keeps the conversions of the
+next sweep running while it reads the rest of the bus instead. The result
+is a structured array with one row per sensor:
+`
+id      uint64   ROM ID of the sensor
+raw     int16    Temperature in units of 1/16 degree, as read from the sensor
+status  uint8    Zero, or a combination of the flags below
+time    float64  When the scratchpad was read (seconds since the epoch)
+`
+Use toCelsius() to convert the raw values of a whole sweep at once.
+
+This module requires NumPy.
+"""
+
+import math
+import time
+
+import numpy
+
+import onewire
+from enum import enum
+
+flags = enum(BADCRC=0x01,      # The scratchpad had a bad CRC
+             NOPRESENCE=0x02,  # The sensor did not respond
+             POWERON=0x04)     # Raw value is the power on value, 85 degrees
+
+POWERONRAW = 0x0550
+
+resultType = numpy.dtype([('id', '<u8'),
+                          ('raw', '<i2'),
+                          ('status', 'u1'),
+                          ('time', '<f8')])
+
+
+def emptyResult(sensors):
+    """
+    Return a result array for the sensors, with all status set to
+    NOPRESENCE.
+    """
+    result = numpy.zeros(len(sensors), dtype = resultType)
+    result['id'] = [sensor.id for sensor in sensors]
+    result['status'] = flags.NOPRESENCE
+    return result
+
+def readInto(result, index, sensor, scratchpads, checkCRC):
+    """
+    Read the scratchpad of a sensor into row index of result. The two
+    temperature bytes are stored in scratchpads, to be converted for the
+    whole sweep at once by finish().
+    """
+    try:
+        scratchpad = sensor.readScratchpad(checkCRC)
+        scratchpads[index] = scratchpad[:2]
+        result['status'][index] = 0
+    except onewire.BadCRC:
+        result['status'][index] = flags.BADCRC
+    except onewire.CommError:
+        result['status'][index] = flags.NOPRESENCE
+
+    result['time'][index] = time.time()
+
+def finish(result, scratchpads):
+    """
+    Convert the stored temperature bytes to signed raw values.
+    """
+    # Two little endian bytes viewed as a signed 16 bit integer
+    result['raw'] = scratchpads.view('<i2')[:, 0]
+    result['status'][(result['raw'] == POWERONRAW) &
+                     (result['status'] == 0)] |= flags.POWERON
+    return result
+
+def sweep(sensors, checkCRC = True):
+    """
+    Convert and read the temperature of all sensors on one bus.
+
+    sensors is a list of DS18B20 objects sharing the same OneWire, for
+    instance DeviceRegistry.family(0x28). Returns a structured array of
+    resultType.
+    """
+    result = emptyResult(sensors)
+    if not sensors:
+        return result
+
+    if not onewire.DS18B20.convertAll(sensors[0].ow):
+        result['time'] = time.time()
+        return result
+
+    scratchpads = numpy.zeros((len(sensors), 2), dtype = 'u1')
+    for index, sensor in enumerate(sensors):
+        readInto(result, index, sensor, scratchpads, checkCRC)
+
+    return finish(result, scratchpads)
+
+class StaggeredSweep:
+    """
+    Sweeps externally powered sensors over and over, with the conversions
+    overlapping the reads. Each sensor is started with its own conversion
+    command, so this does not work for parasite powered sensors.
+
+    The sensors are split into groups. A group is read, and its sensors
+    are then started on the conversion that the next sweep will read.
+    While they convert, the other groups are read and restarted. As long
+    as reading a group takes at least the conversion time and there are two
+    groups or more, no sweep but the first ever waits for a conversion. A
+    sweep then takes the time to read and start all sensors, instead of
+    that plus the conversion time.
+
+    The group size is chosen from the measured time to read and start one
+    sensor, unless groupSize is given. Because the conversions are started
+    by the previous sweep, a reading is as old as the time between sweeps.
+    The time column of the result is therefore when the conversion ended,
+    not when the scratchpad was read. Conversions older than maxAge seconds
+    are started again, and waited for, instead of being returned.
+
+    conversionTime is the time in seconds of one conversion, 0.75 at 12
+    bit resolution.
+    """
+    def __init__(self, sensors, conversionTime = 0.75, checkCRC = True,
+                 groupSize = None, maxAge = None):
+        self.sensors = list(sensors)
+        self.conversionTime = conversionTime
+        self.checkCRC = checkCRC
+        self.fixedGroupSize = groupSize
+        self.maxAge = maxAge
+
+        # When the running conversion of each sensor is done, or None if
+        # the sensor has no conversion running
+        self.doneAt = [None] * len(self.sensors)
+
+        # The same in seconds since the epoch, for the result
+        self.convertedAt = [None] * len(self.sensors)
+
+        # Measured seconds to read and restart one sensor
+        self.readTime = None
+
+    def groupSize(self):
+        if self.fixedGroupSize:
+            return self.fixedGroupSize
+        if not self.readTime:
+            # Nothing measured yet. One group, like a plain sweep.
+            return max(1, len(self.sensors))
+        return max(1, math.ceil(self.conversionTime / self.readTime))
+
+    def start(self, index):
+        try:
+            self.sensors[index].startConversion()
+            self.doneAt[index] = time.monotonic() + self.conversionTime
+            self.convertedAt[index] = time.time() + self.conversionTime
+        except onewire.CommError:
+            self.doneAt[index] = None
+            self.convertedAt[index] = None
+
+    def __call__(self):
+        """
+        Read all sensors once, and return a structured array of resultType.
+        """
+        result = emptyResult(self.sensors)
+        scratchpads = numpy.zeros((len(self.sensors), 2), dtype = 'u1')
+
+        # Start the sensors without a running conversion, which is all of
+        # them the first time, and those with too old a conversion
+        now = time.monotonic()
+        for index, doneAt in enumerate(self.doneAt):
+            if doneAt is None or \
+               (self.maxAge is not None and now - doneAt > self.maxAge):
+                self.start(index)
+
+        size = self.groupSize()
+        spent = 0.0
+        count = 0
+        for first in range(0, len(self.sensors), size):
+            group = range(first, min(first + size, len(self.sensors)))
+
+            started = [self.doneAt[index] for index in group
+                       if self.doneAt[index] is not None]
+            if started:
+                wait = max(started) - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+
+            begin = time.monotonic()
+            for index in group:
+                if self.doneAt[index] is None:
+                    # Did not respond when started
+                    result['time'][index] = time.time()
+                    continue
+                readInto(result, index, self.sensors[index], scratchpads,
+                         self.checkCRC)
+                result['time'][index] = self.convertedAt[index]
+
+            # Convert again for the next sweep while the other groups are
+            # read
+            for index in group:
+                self.start(index)
+
+            spent += time.monotonic() - begin
+            count += len(group)
+
+        if count:
+            self.readTime = spent / count
+
+        return finish(result, scratchpads)
+
+def toCelsius(result):
+    """
+    Return the temperatures of a sweep as an array of float degrees.
+    Rows with a bad status are NaN.
+    """
+    temperatures = result['raw'] / 16.0
+    temperatures[(result['status'] & (flags.BADCRC | flags.NOPRESENCE)) != 0] \
+        = numpy.nan
+    return temperatures
@@ -1,8 +1,15 @@
 #!/usr/bin/python3
 # -*- Coding: utf-8 -*-
 
-import unittest, sys
-import onewire, simulator
+import unittest, sys, os, tempfile, threading, math, time
+import onewire, simulator, readings, busdaemon, deadband, rollup, health
+import profiling, history, random, scenarios
+
+try:
+    import sweep
+except ImportError:
+    # NumPy is not installed
+    sweep = None
 
 class TestOW(unittest.TestCase):
     def setUp(self):
@@ -50,5 +57,486 @@ class TestOW(unittest.TestCase):
         for d in foundDevices:
             self.assertTrue('%16x'%d in devices)
 
+class TestDS18B20(unittest.TestCase):
+    devices = [(0x2b0000047ff88528, 21.5),
+               (0x4e0000047fae9428, -10.125),
+               (0x5400000480970528, 85.0),
+               (0x570000047fedf828, -55.0)]
+
+    def setUp(self):
+        self.ow = onewire.OneWire(simulated  = True)
+        self.stdout = sys.stdout
+        sys.stdout = None
+        self.sensors = []
+        for deviceID, temperature in self.devices:
+            device = simulator.DS18B20device(deviceID, temperature)
+            device.conversionDelay = 3
+            self.ow.uart.attachOWdevice(device)
+            self.sensors.append(onewire.DS18B20(self.ow, deviceID))
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def testReadTemp(self):
+        for sensor, (deviceID, temperature) in zip(self.sensors, self.devices):
+            self.assertEqual(sensor.readTemp(), temperature)
+            self.assertEqual(sensor.readTemp(checkCRC = True), temperature)
+
+        self.ow.uart.devices[0].badCRC = True
+        self.assertRaises(onewire.BadCRC, self.sensors[0].readTemp, True)
+
+    def testRegistry(self):
+        self.ow.uart.attachOWdevice(simulator.OWdevice(0xce0000047ff88510))
+        registry = onewire.DeviceRegistry(self.ow)
+
+        self.assertEqual(len(registry.devices), 5)
+        self.assertEqual(type(registry.devices[0xce0000047ff88510]),
+                         onewire.OWDevice)
+        self.assertEqual(len(registry.family(0x28)), 4)
+        self.assertTrue(registry.add(0x2b0000047ff88528) is
+                        registry.devices[0x2b0000047ff88528])
+
+        self.ow.uart.devices[1].badCRC = True
+        for i in range(2):
+            readings = dict((device.id, (device.value, device.error))
+                            for device in registry.sweep())
+        self.assertEqual(len(readings), 4)
+        for deviceID, temperature in self.devices:
+            value, error = readings[deviceID]
+            if deviceID == 0x4e0000047fae9428:
+                self.assertTrue(isinstance(error, onewire.BadCRC))
+            else:
+                self.assertEqual((value, error), (temperature, None))
+
+    def testHealth(self):
+        registry = onewire.DeviceRegistry(self.ow)
+        monitor = health.BusHealth(self.ow, probeAfter = 2)
+        self.assertEqual(self.ow.batchSize, 64)
+
+        self.assertEqual(len(list(monitor.sweep(registry))), 4)
+        report = monitor.report()
+        self.assertEqual(report['profile'], 'fast')
+        self.assertEqual(report['presence'], {'e0': 8})
+        self.assertEqual(report['echoErrorRate'], 0.0)
+
+        # CRC errors make the monitor fall back
+        self.ow.uart.devices[1].badCRC = True
+        list(monitor.sweep(registry))
+        self.assertEqual(monitor.report()['crcErrorRate'], 1 / 8)
+        self.assertEqual(self.ow.batchSize, 8)
+
+        # Clean sweeps make it probe the faster profile again
+        self.ow.uart.devices[1].badCRC = False
+        for i in range(2):
+            list(monitor.sweep(registry))
+        self.assertEqual(self.ow.batchSize, 64)
+
+        # A failed probe doubles the wait for the next one
+        monitor.record({}, 100, 1, 4, 0, 0)
+        for i in range(3):
+            monitor.record({}, 100, 0, 4, 0, 0)
+        self.assertEqual(self.ow.batchSize, 8)
+        monitor.record({}, 100, 0, 4, 0, 0)
+        self.assertEqual(self.ow.batchSize, 64)
+
+        # The probe is not over after one clean sweep. An error within the
+        # limits still fails it.
+        monitor.record({}, 100, 0, 4, 0, 0)
+        monitor.record({}, 10000, 1, 4, 0, 0)
+        self.assertEqual(self.ow.batchSize, 8)
+        self.assertEqual(monitor.backoff, 4)
+
+        # probeAfter clean sweeps on the faster profile confirm it
+        for i in range(8 + 2):
+            monitor.record({}, 100, 0, 4, 0, 0)
+        self.assertEqual(self.ow.batchSize, 64)
+        self.assertFalse(monitor.probing)
+        self.assertEqual(monitor.backoff, 1)
+
+        # The wait between probes does not grow without end
+        for i in range(10):
+            monitor.record({}, 100, 1, 4, 0, 0)
+            while self.ow.batchSize != 64:
+                monitor.record({}, 100, 0, 4, 0, 0)
+        self.assertEqual(monitor.backoff, 16)
+
+    def testHealthDeviceFault(self):
+        registry = onewire.DeviceRegistry(self.ow)
+        monitor = health.BusHealth(self.ow, probeAfter = 2)
+
+        # A detached sensor reads all ones, which fails the CRC at every
+        # profile
+        detached = self.ow.uart.devices.pop(1)
+        for i in range(3):
+            list(monitor.sweep(registry))
+        self.assertEqual(self.ow.batchSize, 1)
+        self.assertEqual(monitor.report()['faults'], ['%016x' % detached.deviceID])
+
+        # It does not keep the bus at the safe profile
+        for i in range(8):
+            list(monitor.sweep(registry))
+        self.assertEqual(self.ow.batchSize, 64)
+        self.assertFalse(monitor.probing)
+
+        # Once it is read correctly, it counts again
+        self.ow.uart.devices.insert(1, detached)
+        list(monitor.sweep(registry))
+        self.assertEqual(monitor.faults, set())
+
+    def testProfiling(self):
+        directory = tempfile.mkdtemp()
+        controlFile = os.path.join(directory, 'profile-now')
+        registry = onewire.DeviceRegistry(self.ow)
+        profiler = profiling.Profiler(directory, controlFile = controlFile)
+        reset = onewire.OneWire.reset
+
+        with open(controlFile, 'wt') as f:
+            f.write('2\n')
+        for i in range(3):
+            profiler.beforeSweep()
+            list(registry.sweep())
+            profiler.afterSweep()
+
+        self.assertFalse(os.path.exists(controlFile))
+        self.assertTrue(onewire.OneWire.reset is reset)
+        names = sorted(os.listdir(directory))
+        self.assertEqual([os.path.splitext(n)[1] for n in names],
+                         ['.phases', '.prof', '.tracemalloc'])
+
+        with open(os.path.join(directory, names[0])) as f:
+            lines = f.read().splitlines()
+        # Two sweeps of four sensors, each with two selects
+        self.assertEqual([line.split()[1:3] for line in lines[:4]],
+                         [['convert', '16'], ['read', '8'],
+                          ['reset', '16'], ['select', '16']])
+        self.assertEqual(len(lines), 4 + 16 + 8 + 16 + 16)
+
+        for name in names:
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    @unittest.skipIf(sweep is None, 'NumPy is not installed')
+    def testSweep(self):
+        self.ow.uart.devices[1].badCRC = True
+        result = sweep.sweep(self.sensors)
+
+        self.assertEqual(list(result['id']), [d[0] for d in self.devices])
+        self.assertEqual(list(result['raw']), [344, 0, 0x550, -880])
+        self.assertEqual(list(result['status']),
+                         [0, sweep.flags.BADCRC, sweep.flags.POWERON, 0])
+
+        staggered = sweep.StaggeredSweep(self.sensors, conversionTime = 0.01)
+        for i in range(2):
+            result = staggered()
+            self.assertEqual(list(result['raw']), [344, 0, 0x550, -880])
+            self.assertEqual(list(result['status']),
+                             [0, sweep.flags.BADCRC, sweep.flags.POWERON, 0])
+        # One conversion by the plain sweep, and one started before and one
+        # after each read by the staggered sweep
+        for device in self.ow.uart.devices:
+            self.assertEqual(device.conversions, 4)
+        self.assertTrue(staggered.readTime > 0)
+        self.assertEqual(staggered.groupSize(),
+                         math.ceil(0.01 / staggered.readTime))
+
+        temperatures = sweep.toCelsius(result)
+        self.assertEqual(temperatures[0], 21.5)
+        self.assertTrue(temperatures[1] != temperatures[1]) # NaN
+        self.assertEqual(list(temperatures[2:]), [85.0, -55.0])
+
+    @unittest.skipIf(sweep is None, 'NumPy is not installed')
+    def testStaggeredSweep(self):
+        events = []
+        def traced(name, function):
+            def tracer(sensor, *args):
+                events.append((name, sensor.id))
+                return function(sensor, *args)
+            return tracer
+
+        start = onewire.DS18B20.startConversion
+        read = onewire.DS18B20.readScratchpad
+        onewire.DS18B20.startConversion = traced('start', start)
+        onewire.DS18B20.readScratchpad = traced('read', read)
+        try:
+            staggered = sweep.StaggeredSweep(self.sensors,
+                                             conversionTime = 0.2,
+                                             groupSize = 2)
+            staggered()
+            # The conversions for the next sweep run in the meantime
+            time.sleep(0.2)
+            del events[:]
+            began = time.monotonic()
+            wallClock = time.time()
+            result = staggered()
+            elapsed = time.monotonic() - began
+            pipelined = list(events)
+
+            # Conversions older than maxAge are done again
+            staggered.maxAge = 0.1
+            time.sleep(0.4)
+            began = time.monotonic()
+            fresh = staggered()
+            waited = time.monotonic() - began
+        finally:
+            onewire.DS18B20.startConversion = start
+            onewire.DS18B20.readScratchpad = read
+
+        self.assertEqual(list(result['raw']), [344, -162, 0x550, -880])
+
+        # The first group is read and converting again before the second
+        # group is read, so reads happen before all starts are done
+        ids = [deviceID for deviceID, temperature in self.devices]
+        self.assertEqual(pipelined,
+                         [('read', ids[0]), ('read', ids[1]),
+                          ('start', ids[0]), ('start', ids[1]),
+                          ('read', ids[2]), ('read', ids[3]),
+                          ('start', ids[2]), ('start', ids[3])])
+
+        # The conversions ran between the sweeps, so the sweep does not
+        # wait for one. A plain sweep takes at least the conversion time.
+        self.assertTrue(elapsed < 0.1, elapsed)
+
+        # The readings are stamped with when they were converted
+        self.assertTrue(all(result['time'] < wallClock))
+        self.assertTrue(waited >= 0.2, waited)
+        self.assertTrue(all(fresh['time'] > wallClock + 0.4))
+        self.assertEqual(list(fresh['raw']), list(result['raw']))
+
+
+class TestReadings(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def testPublish(self):
+        table = readings.ReadingsTable(self.path, capacity = 2)
+        reader = readings.ReadingsReader(self.path)
+
+        self.assertEqual(reader.get(0x2b0000047ff88528), None)
+
+        table.update(0x2b0000047ff88528, 21.5, timestamp = 100.0)
+        table.update(0x4e0000047fae9428, -3.25, readings.status.BADCRC, 101.0)
+        self.assertEqual(reader.get(0x2b0000047ff88528),
+                         (21.5, 100.0, readings.status.OK))
+
+        table.update(0x2b0000047ff88528, 22.0, timestamp = 102.0)
+        self.assertEqual(reader.readAll(),
+                         {0x2b0000047ff88528: (22.0, 102.0,
+                                               readings.status.OK),
+                          0x4e0000047fae9428: (-3.25, 101.0,
+                                               readings.status.BADCRC)})
+
+        self.assertRaises(readings.TableFull, table.update, 0x28, 0.0)
+
+        # A restarted writer starts over with an empty table, also with
+        # another capacity
+        table.close()
+        table = readings.ReadingsTable(self.path, capacity = 2)
+        self.assertEqual(reader.get(0x2b0000047ff88528), None)
+        table.close()
+        table = readings.ReadingsTable(self.path, capacity = 1)
+        table.update(0x4e0000047fae9428, 1.5, timestamp = 103.0)
+        # The file is never shrunk under a reader
+        self.assertEqual(os.path.getsize(self.path),
+                         readings.header.size + 2 * readings.slot.size)
+        self.assertEqual(reader.readAll(),
+                         {0x4e0000047fae9428: (1.5, 103.0,
+                                               readings.status.OK)})
+
+        # A writer killed in the middle of an update leaves the slot busy
+        readings.sequence.pack_into(table.map, readings.header.size, 3)
+        reader.timeout = 0.01
+        self.assertRaises(readings.TableBusy, reader.get, 0x4e0000047fae9428)
+
+        table.close()
+        reader.close()
+
+class TestDeadband(unittest.TestCase):
+    def testAccept(self):
+        f = deadband.DeadbandFilter(absolute = 0.0625, maxInterval = 60)
+        nan = float('nan')
+        samples = [(0, 20.0, True),    # First reading
+                   (1, 20.0625, False),# Within resolution
+                   (2, 20.125, True),  # Moved two steps
+                   (3, nan, True),     # Failing
+                   (4, nan, False),
+                   (5, 20.125, True),  # Recovered
+                   (65, 20.125, True), # Heartbeat
+                   (66, 19.9, True)]
+        for timestamp, value, emitted in samples:
+            self.assertEqual(f.accept(0x28, value, timestamp), emitted)
+
+        # Per sensor settings
+        f.configure(0x1028, relative = 0.1, minInterval = 10)
+        self.assertTrue(f.accept(0x1028, 20.0, 0))
+        self.assertFalse(f.accept(0x1028, 30.0, 5))
+        self.assertFalse(f.accept(0x1028, 21.0, 10))
+        self.assertTrue(f.accept(0x1028, 23.0, 11))
+
+class TestRollup(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def testQuery(self):
+        index = rollup.RollupIndex(self.directory)
+        day = 86400
+        # Two readings an hour for three days
+        for t in range(0, 3 * day, 1800):
+            index.add(0x28, t / 3600.0, t)
+        index.add(0x28, float('nan'), 3 * day)
+
+        self.assertEqual(index.query(0x28, 0, 3 * day, step = day),
+                         [(0, 0.0, 23.5, 11.75, 48),
+                          (day, 24.0, 47.5, 35.75, 48),
+                          (2 * day, 48.0, 71.5, 59.75, 48)])
+
+        # A new index continues the files where they end
+        index.close()
+        index = rollup.RollupIndex(self.directory)
+        index.add(0x28, -1.0, 3 * day - 60)
+        hours = index.query(0x28, day + 3600, day + 3 * 3600, 3600)
+        self.assertEqual([h[0] for h in hours], [day + 3600, day + 7200])
+        self.assertEqual(index.query(0x28, 2 * day, 3 * day, day)[0][:3],
+                         (2 * day, -1.0, 71.5))
+
+        self.assertEqual(index.query(0x1028, 0, day), [])
+        index.close()
+
+class TestHistory(unittest.TestCase):
+    def testRingBuffer(self):
+        buffer = history.RingBuffer(capacity = 10, scale = 1)
+        self.assertEqual(buffer.latest(), None)
+
+        rng = random.Random(0)
+        samples = []
+        for i in range(35):
+            t = 1.4e9 + 2 * i
+            v = rng.randint(-880, 2000)
+            buffer.append(t, v)
+            samples.append((t, v))
+
+            window = samples[-10:]
+            values = [v for t, v in window]
+            self.assertEqual(len(buffer), len(window))
+            self.assertAlmostEqual(buffer.mean(), sum(values) / len(values))
+            self.assertEqual(buffer.minimum(), min(values))
+            self.assertEqual(buffer.maximum(), max(values))
+            self.assertEqual(buffer.latest(), (t, v))
+
+            n, mean, least, most, slope = buffer.window(6)
+            self.assertEqual(n, min(4, len(window)))
+            self.assertEqual((least, most),
+                             (min(values[-n:]), max(values[-n:])))
+
+        # A straight line
+        for i in range(10):
+            buffer.append(1.5e9 + i, 100 - 3 * i)
+        self.assertAlmostEqual(buffer.slope(), -3)
+        self.assertAlmostEqual(buffer.window(4)[4], -3)
+
+    def testSensorHistory(self):
+        recent = history.SensorHistory(capacity = 4)
+        for t, value in enumerate([20.0, 20.5, float('nan'), -1.0625]):
+            recent.add(0x28, value, t)
+        self.assertEqual(len(recent.get(0x28)), 3)
+        self.assertEqual(recent.get(0x28).minimum(), -1.0625)
+        self.assertEqual(recent.get(0x1028), None)
+
+class TestScenarios(unittest.TestCase):
+    def testRunAll(self):
+        self.assertEqual(scenarios.makeID(0x047ff885, 0x28), 0x2b0000047ff88528)
+
+        results = scenarios.runAll(scenarios.makeScenarios(
+            sizes = (1, 12, 300), bitErrorRates = (0.0,), repeats = 1), 2)
+        self.assertEqual(len(results), 6)
+        for result in results:
+            self.assertEqual((result['missing'], result['extra'],
+                              result['badReadings']), (0, 0, 0))
+            self.assertEqual(result['searchResets'], result['size'])
+            self.assertEqual(result['sweepResets'], 2 * result['size'])
+
+        lines = scenarios.report(results).splitlines()
+        self.assertEqual(len(lines), 7)
+        self.assertEqual(lines[1].split()[:5], ['random', '0', '1', '1',
+                                                '100%'])
+
+class TestBusDaemon(unittest.TestCase):
+    def setUp(self):
+        self.ow = onewire.OneWire(simulated  = True)
+        self.stdout = sys.stdout
+        sys.stdout = None
+        for deviceID in [0x2b0000047ff88528, 0x4e0000047fae9428]:
+            self.ow.uart.attachOWdevice(simulator.OWdevice(deviceID))
+        self.bus = busdaemon.BusService(self.ow, ttl = 60)
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def testCoalesce(self):
+        started = threading.Event()
+        release = threading.Event()
+        def slowRead():
+            started.set()
+            release.wait()
+            return 42
+
+        results = []
+        def request():
+            results.append(self.bus.request('key', slowRead, 0))
+
+        first = threading.Thread(target = request)
+        first.start()
+        started.wait()
+        second = threading.Thread(target = request)
+        second.start()
+        release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(self.bus.transactions, 1)
+        self.assertEqual(sorted(r[2] for r in results), [False, True])
+        self.assertEqual([r[1] for r in results], [42, 42])
+
+    def testSocket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'onewire.sock')
+        server = busdaemon.BusDaemon({'sim': self.bus}, path)
+        threading.Thread(target = server.serve_forever).start()
+        try:
+            for i in range(3):
+                response = busdaemon.query({'op': 'search'}, path)
+                self.assertEqual(sorted(response['devices']),
+                                 ['2b0000047ff88528', '4e0000047fae9428'])
+            self.assertEqual(self.bus.transactions, 1)
+
+            self.assertRaises(onewire.CommError, busdaemon.query,
+                              {'op': 'search', 'bus': 'other'}, path)
+
+            # A second daemon does not take the socket from a running one
+            self.assertRaises(busdaemon.AlreadyRunning, busdaemon.BusDaemon,
+                              {'sim': self.bus}, path)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # But it replaces a socket left behind
+        server = busdaemon.BusDaemon({'sim': self.bus}, path)
+        threading.Thread(target = server.serve_forever).start()
+        try:
+            self.assertEqual(busdaemon.query({'op': 'search'}, path)['ok'],
+                             True)
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
+
 if __name__ == '__main__':
     unittest.main()